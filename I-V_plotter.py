@@ -5,6 +5,7 @@ import matplotlib.patches as mpatches
 from _helpers import truncate
 from _importer import import_sweeps_from_csv
 from datetime import datetime
+import os
 
 ### measurements of each construct ###
 # first five columns of RQ and first four columns of RQ_construct7 are from mostly the same cells (excluding Na10)!
@@ -40,7 +41,46 @@ bestFitRConstraints = {
 }
 
 
+_imported_measurements = {}  # sweeps csv path -> (size and modification time of the file, imported data)
+_best_poly_fits = {}  # the fitted data and the fit constraints -> best_poly_fit result
+
+
 ### functions ###
+def import_measurement(path):
+    # import_sweeps_from_csv, but each file is parsed only once (and again only if it was changed in the meantime)
+    file_stat = os.stat(path)
+    file_version = (file_stat.st_size, file_stat.st_mtime_ns)
+    if path not in _imported_measurements or _imported_measurements[path][0] != file_version:
+        _imported_measurements[path] = (file_version, import_sweeps_from_csv(path))
+    return _imported_measurements[path][1]
+
+
+def get_fit_key(x, y, y_SD=None, best_r=True):
+    # the data itself (and the constraints) is the key, so a changed file or different averages are never mistaken
+    return (np.asarray(x, dtype=float).tobytes(), np.asarray(y, dtype=float).tobytes(),
+            None if y_SD is None else np.asarray(y_SD, dtype=float).tobytes(), best_r,
+            tuple(sorted(bestFitRConstraints.items())), tuple(sorted(bestFitChiConstraints.items())))
+
+
+def cached_best_poly_fits(xs, ys, y_SDs=None, best_r=True):
+    # best_poly_fits, but the same data are fitted only once. the others are fitted together, stacked by their length
+    fit_keys = [get_fit_key(x, y, None if y_SDs is None else y_SDs[i], best_r) for i, (x, y) in enumerate(zip(xs, ys))]
+    unfitted_indices = {}  # number of points -> indices of the measurements
+    for i, fit_key in enumerate(fit_keys):
+        if fit_key not in _best_poly_fits:
+            unfitted_indices.setdefault(len(xs[i]), []).append(i)
+    for indices in unfitted_indices.values():
+        fit_results = best_poly_fits([xs[i] for i in indices], [ys[i] for i in indices],
+                                     None if y_SDs is None else [y_SDs[i] for i in indices], best_r)
+        for i, fit_result in zip(indices, fit_results):
+            _best_poly_fits[fit_keys[i]] = fit_result
+    return [_best_poly_fits[fit_key] for fit_key in fit_keys]
+
+
+def cached_best_poly_fit(x, y, y_SD=None, best_r=True):
+    return cached_best_poly_fits([x], [y], None if y_SD is None else [y_SD], best_r)[0]
+
+
 def get_path_list(construct_name):  # name as appears under the dic "measurements"
     const_path_list = []
     for measurement in measurement_names[construct_name]:
@@ -56,8 +96,8 @@ def normalize_measurement(measurement_dic, ref_measurement_dic, normalization_vo
                                                                                            "currents"], \
                                                                                        ref_measurement_dic[
                                                                                            "currents_std"]
-    ref_measurement_best_fit_result = best_poly_fit(ref_measurement_voltages,
-                                                    ref_measurement_currents)  # opt: y_SD=ref_measurement_dic["currents_std"]
+    ref_measurement_best_fit_result = cached_best_poly_fit(ref_measurement_voltages,
+                                                           ref_measurement_currents)  # opt: y_SD=ref_measurement_dic["currents_std"]
     ref_fit_polynomial = ref_measurement_best_fit_result['polynomial']
     ref_current_at_norm_voltage = ref_fit_polynomial(normalization_voltage)
     normalized_currents = np.asarray(measurement_currents) / ref_current_at_norm_voltage
@@ -81,15 +121,18 @@ def average_measurements(construct_paths_list, get_Erev_stats=True):
     assert len(construct_paths_list) >= 2, "At least 2 measurements for averaging!"
     voltages_list_of_lists = []
     currents_list_of_lists = []
-    E_rev_list_of_lists = []
+    currents_std_list_of_lists = []
     for measurement in construct_paths_list:
-        measurement_data = import_sweeps_from_csv(measurement)
+        measurement_data = import_measurement(measurement)
         measurement_voltages, measurement_currents,measurement_currents_std = measurement_data["voltages"], measurement_data[
             "currents"],measurement_data['currents_std']
         voltages_list_of_lists.append(measurement_voltages)
         currents_list_of_lists.append(measurement_currents)
-        if get_Erev_stats:
-            measurement_best_fit_result = best_poly_fit(measurement_voltages, measurement_currents, y_SD=measurement_currents_std)
+        currents_std_list_of_lists.append(measurement_currents_std)
+    if get_Erev_stats:  # the measurements are fitted together
+        E_rev_list_of_lists = []
+        for measurement_voltages, measurement_best_fit_result in zip(voltages_list_of_lists, cached_best_poly_fits(
+                voltages_list_of_lists, currents_list_of_lists, currents_std_list_of_lists)):
             ref_poly_function = measurement_best_fit_result['polynomial']
             measurement_E_rev = get_closest_value_to_data(ref_poly_function.roots, measurement_voltages)
             E_rev_list_of_lists.append(measurement_E_rev)
@@ -166,25 +209,66 @@ def polyfit_with_stats(x, y, degree, y_SD=None):
     return results
 
 
-def best_poly_fit(x, y, y_SD=None, best_r=True):
-    result = polyfit_with_stats(x, y, 1, y_SD=y_SD)
-    for deg in range(2, 10):
-        next_deg_result = polyfit_with_stats(x, y, deg, y_SD=y_SD)
+def best_poly_fits(x, y, y_SD=None, best_r=True, max_degree=9):
+    """
+    best_poly_fit of many measurements at once. the weighted vandermonde matrix of each measurement is factorized
+    once, and the fits of all degrees (up to max_degree, and below the number of points) are solved from it, as
+    its first columns are those of the lower degrees
+    :param x: the x data, of shape (measurements, points)
+    :param y: the y data, of the same shape
+    :param y_SD: None, or the standard deviations of the y data, of the same shape
+    :return: a list of the best fit results (as of polyfit_with_stats), one per measurement
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    weights = np.ones(y.shape) if y_SD is None else 1 / np.asarray(y_SD, dtype=float)
+    degrees = np.arange(1, min(max_degree, x.shape[1] - 1) + 1)
+    powers = x[..., np.newaxis] ** np.arange(degrees[-1] + 1)  # (measurements, points, powers), lowest power first
+    weighted_powers = powers * weights[..., np.newaxis]
+    column_scales = np.sqrt(np.sum(weighted_powers ** 2, axis=1, keepdims=True))  # as np.polyfit, for conditioning
+    q, r = np.linalg.qr(weighted_powers / column_scales)
+    q_t_y = np.einsum('mpc,mp->mc', q, y * weights)
+
+    y_bar = np.mean(y, axis=1, keepdims=True)
+    ss_tot = np.sum((y - y_bar) ** 2, axis=1)
+    fits = []
+    for degree in degrees:
+        scaled_coefficients = np.linalg.solve(r[:, :degree + 1, :degree + 1], q_t_y[:, :degree + 1, np.newaxis])
+        coefficients = scaled_coefficients[..., 0] / column_scales[:, 0, :degree + 1]  # lowest power first
+        f = np.einsum('mpc,mc->mp', powers[..., :degree + 1], coefficients)  # fit values for x_data
+        ss_res = np.sum((y - f) ** 2, axis=1)
+        chi_squared = ss_res if y_SD is None else np.sum(((y - f) ** 2) / np.asarray(y_SD, dtype=float), axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fits.append({'coefficients': coefficients[:, ::-1], 'r-squared': 1 - ss_res / ss_tot,
+                         'red-chi-squared': chi_squared / (x.shape[1] - (degree + 1))})
+
+    # as best_poly_fit, a degree is taken if it is a better fit than the one below it, until one is not
+    r_squared = np.array([fit['r-squared'] for fit in fits])  # (degrees, measurements)
+    red_chi_squared = np.array([fit['red-chi-squared'] for fit in fits])
+    if best_r:
+        better_fits = r_squared[1:] - r_squared[:-1] > bestFitRConstraints['min_r_squared_delta_improvement']
+    else:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            better_fits = (red_chi_squared[:-1] / red_chi_squared[1:] >
+                           bestFitChiConstraints['min_red_chi_squared_improvement_ratio']) & \
+                          (red_chi_squared[1:] > bestFitChiConstraints['min_red_chi_squared_value']) & \
+                          (r_squared[:-1] / r_squared[1:] < bestFitChiConstraints['max_r_squared_deterioration_ratio'])
+    not_better_fits = np.vstack([~better_fits, np.ones((1, len(x)), dtype=bool)])
+    best_degree_indices = np.argmax(not_better_fits, axis=0)
+
+    results = []
+    for measurement_index, degree_index in enumerate(best_degree_indices):
+        fit = fits[degree_index]
+        coefficients = fit['coefficients'][measurement_index]
+        results.append({'degree': int(degrees[degree_index]), 'coefficients': list(coefficients),
+                        'polynomial': np.poly1d(coefficients),
+                        'r-squared': fit['r-squared'][measurement_index],
+                        'red-chi-squared': fit['red-chi-squared'][measurement_index]})
+    return results
 
-        if best_r:
-            r_squared_delta = next_deg_result['r-squared'] - result['r-squared']
-            better_fit_condition = r_squared_delta > bestFitRConstraints['min_r_squared_delta_improvement']
-        else:
-            red_chi_sq_ratio = result['red-chi-squared'] / next_deg_result['red-chi-squared']
-            r_squared_ratio = result['r-squared'] / next_deg_result['r-squared']
-            better_fit_condition = red_chi_sq_ratio > bestFitChiConstraints['min_red_chi_squared_improvement_ratio'] and \
-                                   next_deg_result['red-chi-squared'] > bestFitChiConstraints[
-                                       'min_red_chi_squared_value'] and \
-                                   r_squared_ratio < bestFitChiConstraints['max_r_squared_deterioration_ratio']
-        if better_fit_condition:
-            result = next_deg_result
-        else:
-            return result
+
+def best_poly_fit(x, y, y_SD=None, best_r=True):
+    return best_poly_fits([x], [y], None if y_SD is None else [y_SD], best_r)[0]
 
 
 def get_closest_value_to_data(list_of_values, data):
@@ -205,7 +289,7 @@ def plot_iv_curve(measurements, get_Erev_stats=False):
                                                                measurement['currents_std'], \
                                                                measurement['voltages_std']
 
-        bestFitResult = best_poly_fit(voltages, currents, y_SD=currents_std)
+        bestFitResult = cached_best_poly_fit(voltages, currents, y_SD=currents_std)
         # bestFitResult = polyfit_with_stats(voltagesList, currentsList, 2, y_SD=None)
         refPolyFunction = bestFitResult['polynomial']
 
@@ -1,9 +1,5 @@
-from _abfAnalysis import *
-from _fitting import *
-from _importer import *
+import importlib.util
 import sys
-import os
-from _loggerInitializer import *
 
 
 def no_args_dialog():
@@ -15,8 +11,8 @@ def no_args_dialog():
     if py_ver < 3.5:
         raise Exception("Python ver. " + str(py_ver) + " is too old. Python 3.5 or above is required")
     print("checking if installed...")
-    for module in needed_modules:
-        if module not in sys.modules:
+    for module in needed_modules:  # only looked up, the modules are imported once an analysis is run
+        if importlib.util.find_spec(module.split('.')[0]) is None:
             raise ModuleNotFoundError(module)
     print("modules are indeed installed!")
     print("Please run \'TECV_analyzer.py --options\' for the different options of running this script ")
@@ -41,59 +37,85 @@ def options_dialog():
     print('<path_to_abf_file> : the path to a specific .abf file')
     print('<path_to_folder> : the path to a specific the folder where the to be analyzed .abf files are')
     print(' ')
+    print('Instead of \'--run\', \'--watch\' (with the same options, and the path of a folder) will keep on watching '
+          'the folder and analyze each new .abf file as soon as it is complete, until stopped with ctrl+c')
+    print(' ')
+    print('Optionally, \'--jobs N\' can be added to analyze the files of a folder in N parallel processes')
+    print('Optionally, \'--sweep-jobs N\' can be added to --run to fit the sweeps of each file in N parallel processes, '
+          'which helps with few files of many long sweeps (not used with --fast-fitting, which fits all sweeps at once)')
+    print('Optionally, \'--fast-fitting\' can be added to solve the baseline fits directly instead of via lmfit')
+    print('Optionally, \'--npz\' (or \'--npz-float32\' for half the size) can be added to also output the analyzed '
+          'data as a binary file (.npz), which can be loaded with import_analyzed_abf_data_from_npz')
+    print('Optionally, \'--fast-plotting\' can be added to render the plots as decimated raster images (.png) next to '
+          'the analysis instead of as .pdf files')
+    print('Optionally, \'--report\' can be added to put all of the plots of a file into a single multi-page .pdf report '
+          '(<<abf name>>_report.pdf) instead of into a file each')
+    print('Optionally, \'--no-plots\' can be added to only correct the currents and output the data files, without '
+          'any plots')
+    print('Optionally, \'--no-pipeline\' can be added to --run to read, analyze and write the files strictly one after '
+          'the other. Otherwise, the next file is read and the outputs are written while a file is analyzed')
+    print('Optionally, \'--profile\' and / or \'--trace-memory\' can be added to --run to also output a cProfile '
+          '(profile.txt, profile.pstats) and / or a tracemalloc (memory.txt) summary of the run. The time each stage of '
+          'the analysis took is always written to timings.jsonl')
+    print('Optionally, \'--recursive\' can be added to also analyze (or watch) the .abf files in all subfolders of the '
+          'folder, e.g. of each day and cell')
+    print('Optionally, \'--force\' can be added to analyze all files again. Otherwise, files that have already been '
+          'analyzed with the same options and parameters (see analysis_manifest.json in the output folder) are skipped')
+    print(' ')
     print("FYI: The plots and the analyzed currents and voltage data will be placed in an output folder in the given "
           "abf path along with a log file")
 
 
-def make_log(abf):
-    output_folder_path = abf.make_output_folder()
-    initialize_logger(str(output_folder_path))
+def run(input_option, input_path, **run_options):
+    # the analysis (and with it pyabf, numpy, matplotlib, ...) is only imported here, so that the dialogs start fast
+    from _analysisRunner import run as run_analysis
+    run_analysis(input_option, input_path, **run_options)
 
 
-def run(input_option, input_path):
-    assert input_option is None or input_option == 'u' or input_option == 'p' or input_option == 'v' \
-           or input_option == 'a'
-    print('Input: option, path = ' + str(input_option) + ', ' + str(input_path))
-    if input_path is None:
-        input_path = os.getcwd()
-    if Path(input_path).is_file():
-        abf_to_analyze = input_path
-        imported_single_abf = import_single_abf(abf_to_analyze)
-        abfs_as_list = [imported_single_abf]
-    elif Path(input_path).is_dir():
-        folder_to_analyze = input_path
-        imported_abfs = import_abfs_from_dic(folder_to_analyze)
-        abfs_as_list = imported_abfs
-    else:
-        raise ValueError('Bad path:' + str(input_path) + 'could not be found / is incorrect')
-    make_log(abfs_as_list[0])
-    for abf in abfs_as_list:
-        msg = "analyzing file " + abf.which_abf_file() + " ..."
-        logging.info(msg)
-        if input_option == 'p' or input_option == 'a':
-            for i in range(abf.sweep_count()):
-                sweep_i = abf.get_sweep(i)
-                plot_sweep(sweep_i, save_fig=True)
-        if input_option == 'u' or input_option == 'a':
-            plot_all_sweeps(abf, save_fig=True)
-        try:
-            if input_option == 'v' or input_option == 'a':
-                plot_all_sweeps(abf, correction='pre_light_only', save_fig=True)
-            plot_all_sweeps(abf, correction='pre_and_after_light', save_fig=True)
-            abf.export_analyzed_abf_data_to_csv()
-        except AssertionError:
-            logging.warning('Could not correct the currents in this file. Plotting uncorrected currents and skipping.')
-            plot_all_sweeps(abf, save_fig=True)
+def watch(input_option, input_path, **run_options):
+    from _analysisRunner import watch as watch_folder
+    watch_folder(input_option, input_path, **run_options)
 
 
 def main():
     arguments = sys.argv
+    given_jobs = 1
+    if '--jobs' in arguments:
+        jobs_index = arguments.index('--jobs')
+        assert len(arguments) > jobs_index + 1, 'the number of jobs should follow --jobs'
+        given_jobs = int(arguments[jobs_index + 1])
+        arguments = arguments[:jobs_index] + arguments[jobs_index + 2:]
+    given_sweep_jobs = 1
+    if '--sweep-jobs' in arguments:
+        sweep_jobs_index = arguments.index('--sweep-jobs')
+        assert len(arguments) > sweep_jobs_index + 1, 'the number of sweep jobs should follow --sweep-jobs'
+        given_sweep_jobs = int(arguments[sweep_jobs_index + 1])
+        arguments = arguments[:sweep_jobs_index] + arguments[sweep_jobs_index + 2:]
+    given_fitting_backend = 'lmfit'
+    if '--fast-fitting' in arguments:
+        given_fitting_backend = 'fast'
+        arguments = [argument for argument in arguments if argument != '--fast-fitting']
+    given_npz_export = None
+    if '--npz' in arguments or '--npz-float32' in arguments:
+        given_npz_export = 'float32' if '--npz-float32' in arguments else 'float64'
+        arguments = [argument for argument in arguments if argument != '--npz' and argument != '--npz-float32']
+    given_force = '--force' in arguments
+    given_fast_plotting = '--fast-plotting' in arguments
+    given_report = '--report' in arguments
+    given_plots = '--no-plots' not in arguments
+    given_profile = '--profile' in arguments
+    given_trace_memory = '--trace-memory' in arguments
+    given_recursive = '--recursive' in arguments
+    given_pipeline = '--no-pipeline' not in arguments
+    arguments = [argument for argument in arguments if argument not in (
+        '--force', '--fast-plotting', '--report', '--no-plots', '--profile', '--trace-memory', '--recursive',
+        '--no-pipeline')]
     nr_of_args = len(arguments) - 1
     if nr_of_args == 0:
         no_args_dialog()
     elif arguments[1] == "--options":
         options_dialog()
-    elif arguments[1] == "--run":
+    elif arguments[1] == "--run" or arguments[1] == "--watch":
         if nr_of_args == 1:
             given_option = None
             given_path = None
@@ -117,7 +139,14 @@ def main():
                 given_path = arguments[3] + '/'
         else:
             raise ValueError('given arguments are not available. please see --options')
-        run(given_option, given_path)
+        run_options = {'jobs': given_jobs, 'fitting_backend': given_fitting_backend, 'npz_export': given_npz_export,
+                       'fast_plotting': given_fast_plotting, 'report': given_report, 'plots': given_plots,
+                       'recursive': given_recursive}
+        if arguments[1] == "--run":
+            run(given_option, given_path, force=given_force, profile=given_profile, trace_memory=given_trace_memory,
+                pipeline=given_pipeline, sweep_jobs=given_sweep_jobs, **run_options)
+        else:
+            watch(given_option, given_path, **run_options)
     else:
         raise ValueError('given arguments are not available. please see --options')
 
@@ -0,0 +1,419 @@
+from _abfAnalysis import *
+from _importer import import_single_abf
+from types import SimpleNamespace
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+
+### parameters ###
+synthetic_sample_rate = 20000       # [Hz] , the sampling rate of the synthetic sweeps
+synthetic_sweep_duration = 6        # [sec] , the duration of a synthetic sweep
+synthetic_epochs = (0.5, 2, 3.5, 5.5)  # [sec] , clamp on, shutter on, shutter off and clamp off of a synthetic sweep
+benchmark_repeats = 5               # the number of times each benchmark is repeated (the best time is reported)
+synthetic_nr_of_sweeps = 10        # the number of sweeps of a synthetic recording
+synthetic_drift = (0.2, 0.8)        # [nA, sec] , the amplitude and the time constant of the exponential dark current drift
+synthetic_photocurrent = (0.05, 0.05)  # [nA, sec] , the amplitude (at -100 mV) and the time constant of the photocurrents
+parity_drift_taus = (0.05, 0.2, 0.8, 5)  # [sec] , the time constants of the dark current drifts of the parity check
+parity_exponential_drifts = ((2, 1), (5, 2))  # [nA, sec] , drifts of the parity check that are clearly exponential in
+                                    # both fit windows, so that the fits are far from the threshold of the best function
+parity_max_red_chi_difference = 1e-3  # the largest relative difference of the reduced chis of the best fits (and by
+                                    # which the exponential fits of the fast backend may be worse than lmfit's)
+parity_max_curve_difference = 1e-3  # the largest difference of the best fit curves, relative to the range of the data
+suite_repeats = 3                   # the number of times each stage of the suite is repeated (the best time is reported)
+suite_index_lookups = 1000          # the number of index lookups that are timed
+heavy_modules = ('matplotlib', 'pandas', 'lmfit', 'scipy', 'pyabf', 'numpy')  # reported if a startup imports them
+startup_commands = {'no arguments dialog': ['TEVC_analyzer.py'],
+                    'options dialog': ['TEVC_analyzer.py', '--options'],
+                    'import of the analysis': ['-c', 'import _analysisRunner'],
+                    'import of the analysis with fast fitting': [
+                        '-c', 'import _analysisRunner; _analysisRunner.set_fitting_backend("fast")']}
+
+##################
+
+
+class synthetic_sweep:
+    # has the attributes of a sweep that the fitting and the baseline correction use, without an .abf file behind it
+    def __init__(self, sample_rate=synthetic_sample_rate, duration=synthetic_sweep_duration, epochs=synthetic_epochs,
+                 seed=0, drift_tau=0.8, drift_amplitude=synthetic_drift[0]):
+        self.sweep_nr = seed
+        self.sample_interval = 1 / sample_rate
+        self.times = np.arange(int(duration * sample_rate)) * self.sample_interval
+        self.t_clamp_on, self.t_shutter_on, self.t_shutter_off, self.t_clamp_off = epochs
+        self.currents = make_synthetic_currents(self.times, epochs, seed, (drift_amplitude, drift_tau))
+        self.original_currents = self.currents
+        self.currents_are_corrected = False
+        self.correction_type = None
+
+    def set_corrected_currents(self, corrected_currents, correction_type):
+        self.currents = corrected_currents
+        self.currents_are_corrected = True
+        self.correction_type = correction_type
+
+
+def make_synthetic_currents(times, epochs, seed=0, drift=synthetic_drift, photocurrent=synthetic_photocurrent):
+    """
+    :param epochs: clamp on, shutter on, shutter off and clamp off [sec]
+    :param drift: the amplitude and the time constant of the exponential dark current drift while clamped
+    :param photocurrent: the amplitude and the time constant of the rise and the decay of the photocurrent
+    """
+    t_clamp_on, t_shutter_on, t_shutter_off, t_clamp_off = epochs
+    drift_amplitude, drift_tau = drift
+    photocurrent_amplitude, photocurrent_tau = photocurrent
+    currents = np.zeros(times.shape)
+    clamped = (times >= t_clamp_on) & (times < t_clamp_off)
+    currents[clamped] = first_oder_sys_response(times[clamped] - t_clamp_on, 0.1 + drift_amplitude, 0.1, drift_tau)
+    light_on = (times >= t_shutter_on) & (times < t_shutter_off)
+    currents[light_on] += first_oder_sys_response(times[light_on] - t_shutter_on, 0, photocurrent_amplitude,
+                                                  photocurrent_tau)
+    light_off = (times >= t_shutter_off) & clamped
+    currents[light_off] += first_oder_sys_response(times[light_off] - t_shutter_off, photocurrent_amplitude, 0,
+                                                   photocurrent_tau)
+    return currents + np.random.default_rng(seed).normal(0, 0.002, times.shape)
+
+
+class synthetic_abf(ActiveAbf):
+    """
+    an ActiveAbf of synthetic sweeps (currents, voltages and shutter) with the epoch layout of a recording, so that the
+    whole analysis can be run without an .abf file. the outputs go to the analysis_results folder in output_folder
+    """
+
+    def __init__(self, output_folder, nr_of_sweeps=synthetic_nr_of_sweeps, sample_rate=synthetic_sample_rate,
+                 duration=synthetic_sweep_duration, epochs=synthetic_epochs, drift=synthetic_drift,
+                 photocurrent=synthetic_photocurrent, seed=0):
+        sweep_point_count = int(duration * sample_rate)
+        times = np.arange(sweep_point_count) / sample_rate
+        t_clamp_on, t_shutter_on, t_shutter_off, t_clamp_off = epochs
+        self._input_voltages = [-100 + 20 * (sweep_nr % 6) for sweep_nr in range(nr_of_sweeps)]
+        currents, voltages, shutter = [], [], []
+        for sweep_nr, input_voltage in enumerate(self._input_voltages):
+            sweep_photocurrent = (photocurrent[0] * input_voltage / 100, photocurrent[1])
+            currents.append(make_synthetic_currents(times, epochs, seed + sweep_nr, drift, sweep_photocurrent))
+            clamped = (times >= t_clamp_on) & (times < t_clamp_off)
+            voltages.append(np.where(clamped, input_voltage, -80.) +
+                            np.random.default_rng(seed + sweep_nr).normal(0, 0.2, sweep_point_count))
+            shutter.append(np.where((times >= t_shutter_on) & (times < t_shutter_off), 5., 0.))
+        self.abf_data = SimpleNamespace(dataRate=sample_rate, dataSecPerPoint=1 / sample_rate,
+                                        sweepCount=nr_of_sweeps, sweepPointCount=sweep_point_count)
+        self.data_reader = abf_data_reader(np.column_stack([np.concatenate(currents), np.concatenate(voltages),
+                                                            np.concatenate(shutter)]).astype(np.float32),
+                                           nr_of_sweeps, sweep_point_count)
+        self._epoch_starts = [0] + [int(round(t * sample_rate)) for t in epochs]
+        self._abf_file_path = os.path.join(str(output_folder), 'synthetic.abf')
+        self.initialize_sweeps()
+        self._channel_labels = {0: 'Clamp Current (nA)', 1: 'Membrane Potential (mV)', 2: 'Shutter (V)'}
+
+    def get_sweep_input_voltage(self, sweep_num):
+        return self._input_voltages[sweep_num]
+
+    def get_sweep_epoch_starts(self, sweep_num):
+        return self._epoch_starts
+
+
+def legacy_linear_photocurrent_baseline(sweep, t_ss):
+    # the per-sample loops that calculate_linear_photocurrent_baseline used before, kept as the reference
+    sweep_times = sweep.times
+    sweep_currents = sweep.currents
+    recorded_t_light_on = get_closest_value_from_ordered_array(sweep.t_shutter_on, sweep_times)
+    recorded_t_ss = get_closest_value_from_ordered_array(t_ss, sweep_times)
+    t_ss_index = get_index_of_unique_value(recorded_t_ss, sweep_times)
+    baseline = np.zeros(len(sweep_currents))
+    deltay = np.average(sweep_currents[(t_ss_index - 5):(t_ss_index + 5)])
+    slope = deltay / (recorded_t_ss - sweep.t_shutter_on)
+    t_value_index = 0
+    for t_value in sweep_times:
+        if recorded_t_light_on <= t_value <= recorded_t_ss:
+            baseline[t_value_index] = linear(t_value - recorded_t_light_on, slope, 0)
+        elif t_value > recorded_t_ss:
+            baseline[t_value_index] = linear(recorded_t_ss - recorded_t_light_on, slope, 0)
+        t_value_index += 1
+    return baseline
+
+
+def best_time(function, repeats=benchmark_repeats):
+    return min(timeit.repeat(function, number=1, repeat=repeats))
+
+
+def benchmark_linear_photocurrent_baseline(sweep):
+    t_ss = sweep.t_shutter_off + default_assumed_t_ss
+    legacy_baseline = legacy_linear_photocurrent_baseline(sweep, t_ss)
+    baseline = calculate_linear_photocurrent_baseline(sweep, t_ss=t_ss, fit_also_after_t_ss=False)
+    assert np.array_equal(legacy_baseline, baseline), 'the vectorized baseline differs from the legacy baseline'
+    legacy_time = best_time(lambda: legacy_linear_photocurrent_baseline(sweep, t_ss))
+    vectorized_time = best_time(lambda: calculate_linear_photocurrent_baseline(sweep, t_ss=t_ss,
+                                                                               fit_also_after_t_ss=False))
+    return {'legacy [sec]': legacy_time, 'vectorized [sec]': vectorized_time,
+            'speedup': legacy_time / vectorized_time}
+
+
+def get_imported_heavy_modules(command):
+    # python -X importtime lists every module a command imports
+    import_times = subprocess.run([sys.executable, '-X', 'importtime'] + command, cwd=os.path.dirname(
+        os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+    imported_modules = {line.split('|')[-1].strip() for line in import_times.splitlines() if '|' in line}
+    return [module for module in heavy_modules if module in imported_modules]
+
+
+def benchmark_startup(command):
+    """
+    :param command: the arguments of a python call from the repository folder, e.g. ['TEVC_analyzer.py', '--options']
+    :return: the best time of a cold start of the command and the heavy modules it imported
+    """
+    startup_time = best_time(lambda: subprocess.run([sys.executable] + command, cwd=os.path.dirname(
+        os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True))
+    return {'startup [sec]': startup_time, 'heavy modules': ', '.join(get_imported_heavy_modules(command)) or 'none'}
+
+
+def fit_pre_light_in_order(sweeps, warm_started=True):
+    """
+    fits the dark currents of the sweeps with lmfit one after the other, last one first (as they are corrected), each
+    one warm started from the fit before it or started cold from guess_init_vals
+    :return: the work of the fits, see fit_warm_start.get_fit_work
+    """
+    original_fitting_backend = get_fitting_backend()
+    set_fitting_backend('lmfit')
+    warm_start = fit_warm_start()
+    for sweep_i in sweeps[::-1]:
+        if not warm_started:
+            warm_start.values = None
+        fit_or_fail(fit_pre_light, sweep_i, 'exponential', None, False, warm_start)
+    set_fitting_backend(original_fitting_backend)
+    return warm_start.get_fit_work()
+
+
+def benchmark_stages(active_abf, repeats=suite_repeats):
+    """
+    times each stage of the analysis of a (e.g. synthetic) recording, from the index lookups to the plots
+    :return: the best time [sec] of each stage
+    """
+    import matplotlib
+    matplotlib.use('Agg')  # the plots are only saved
+    sweeps = [active_abf.get_sweep(i) for i in range(active_abf.sweep_count())]
+    times = active_abf.get_sweep_times()
+    sample_interval = sweeps[0].sample_interval
+    lookup_values = list(np.random.default_rng(0).uniform(times[0], times[-1], suite_index_lookups))
+    original_fitting_backend = get_fitting_backend()
+    stage_times = {
+        'index lookups, one at a time': best_time(lambda: [get_index_of_closest_value(
+            lookup_value, times, sample_interval) for lookup_value in lookup_values], repeats),
+        'index lookups, all at once': best_time(lambda: get_indices_of_closest_values(
+            lookup_values, times, sample_interval), repeats)}
+    for backend in ('lmfit', 'fast'):
+        set_fitting_backend(backend)
+        stage_times['fit_pre_light, ' + backend] = best_time(
+            lambda: [fit_pre_light(sweep_i, 'exponential') for sweep_i in sweeps], repeats)
+    set_fitting_backend(original_fitting_backend)
+    stage_times['fit_pre_light, lmfit, warm started'] = best_time(lambda: fit_pre_light_in_order(sweeps), repeats)
+    correct_all_sweeps(active_abf, 'pre_light_only')
+    stage_times['calculate_linear_photocurrent_baseline'] = best_time(
+        lambda: [calculate_linear_photocurrent_baseline(sweep_i) for sweep_i in sweeps], repeats)
+    correct_all_sweeps(active_abf, 'pre_and_after_light')
+    stage_times['get_stst_currents'] = best_time(active_abf.get_stst_currents, repeats)
+    stage_times['get_voltage_changes'] = best_time(active_abf.get_voltage_changes, repeats)
+    stage_times['csv export'] = best_time(active_abf.export_analyzed_abf_data_to_csv, repeats)
+    stage_times['npz export'] = best_time(active_abf.export_analyzed_abf_data_to_npz, repeats)
+    renderer = plot_renderer()
+    stage_times['sweep plot, pdf'] = best_time(lambda: plot_sweep(sweeps[0], save_fig=True), repeats)
+    stage_times['sweep plot, fast'] = best_time(lambda: plot_sweep(sweeps[0], save_fig=True, renderer=renderer),
+                                                repeats)
+    stage_times['all sweeps plot, pdf'] = best_time(lambda: plot_all_sweeps(active_abf, save_fig=True), repeats)
+    stage_times['all sweeps plot, fast'] = best_time(lambda: plot_all_sweeps(active_abf, save_fig=True,
+                                                                             renderer=renderer), repeats)
+    return stage_times
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_suite(results_path=None):
+    """
+    benchmarks the stages of the analysis of a synthetic recording (see the parameters above), without any .abf file
+    :param results_path: if given, the results are written there as json, to be compared with compare_suite_results
+    """
+    configuration = {'sweeps': synthetic_nr_of_sweeps, 'sample rate [Hz]': synthetic_sample_rate,
+                     'sweep duration [sec]': synthetic_sweep_duration, 'epochs [sec]': list(synthetic_epochs),
+                     'drift [nA, sec]': list(synthetic_drift), 'photocurrent [nA, sec]': list(synthetic_photocurrent),
+                     'repeats': suite_repeats}
+    with tempfile.TemporaryDirectory() as output_folder:
+        active_abf = synthetic_abf(output_folder)
+        stage_times = benchmark_stages(active_abf)
+        sweeps = [active_abf.get_sweep(i) for i in range(active_abf.sweep_count())]
+        fit_work = {'cold started': fit_pre_light_in_order(sweeps, warm_started=False),
+                    'warm started': fit_pre_light_in_order(sweeps)}
+    suite_results = {'commit': get_git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+                     'configuration': configuration, 'stages [sec]': stage_times, 'pre light fit work': fit_work}
+    if results_path is not None:
+        with open(results_path, 'w') as results_file:
+            json.dump(suite_results, results_file, indent=2)
+    return suite_results
+
+
+def compare_suite_results(reference_path, results_path):
+    # the times of the stages of two suite runs (e.g. of two commits), and how many times faster the second one is
+    with open(reference_path) as reference_file, open(results_path) as results_file:
+        reference_results, suite_results = json.load(reference_file), json.load(results_file)
+    if reference_results['configuration'] != suite_results['configuration']:
+        print('warning: the suites were run with different configurations')
+    compared = {}
+    for stage, stage_time in suite_results['stages [sec]'].items():
+        if stage in reference_results['stages [sec]']:
+            reference_time = reference_results['stages [sec]'][stage]
+            compared[stage] = {str(reference_results['commit']) + ' [sec]': reference_time,
+                               str(suite_results['commit']) + ' [sec]': stage_time,
+                               'speedup': reference_time / stage_time}
+    return compared
+
+
+def fit_or_fail(fitting_function, *args):
+    try:
+        return fitting_function(*args)
+    except AssertionError:
+        return 'failed', None
+
+
+def get_fit_windows(sweeps):
+    # the times and currents of the pre-light and the after-light fits of each sweep
+    fit_windows = {'pre light': [], 'after light': []}
+    for sweep_i in sweeps:
+        first_index, last_index = get_pre_light_fit_interval(sweep_i)
+        fit_windows['pre light'].append((sweep_i.times[first_index:last_index],
+                                         sweep_i.original_currents[first_index:last_index]))
+        first_index, last_index = get_after_light_fit_interval(sweep_i, sweep_i.t_shutter_off + default_assumed_t_ss)
+        fit_windows['after light'].append((sweep_i.times[first_index:last_index],
+                                           sweep_i.currents[first_index:last_index]))
+    return fit_windows
+
+
+def compare_fits(reference_fits, fits):
+    """
+    :return: the largest relative differences of the reduced chis (by their absolute value, and the largest one by which
+    the fits are worse than the reference) and of the fitted curves (relative to the data range)
+    """
+    compared = [(reference, fit) for reference, fit in zip(reference_fits, fits) if reference is not None]
+    red_chi_differences = [(fit.redchi - reference.redchi) / reference.redchi for reference, fit in compared]
+    curve_differences = [np.max(np.abs(fit.best_fit - reference.best_fit)) / np.ptp(reference.data)
+                         for reference, fit in compared]
+    return max(red_chi_differences, key=abs, default=0), max(red_chi_differences, default=0), \
+        max(curve_differences, default=0)
+
+
+def get_improvement_factor(exp_result, linear_result):  # of the exponential fit, as in select_best_dark_current_fit
+    return 1 - linear_result.redchi / exp_result.redchi
+
+
+def check_fitting_backend_parity(sweeps):
+    """
+    fits the dark currents of the sweeps with both fitting backends, the lmfit one being the reference
+    :param sweeps: a list of sweeps (or synthetic sweeps)
+    :return: per fit window, how many best functions agree, the differences of the fits and the time each backend
+    took, and the failed checks (see parity_max_red_chi_difference and parity_max_curve_difference)
+    """
+    original_fitting_backend = get_fitting_backend()
+    parity = {}
+    for window, fit_windows in get_fit_windows(sweeps).items():
+        exp_fits, linear_fits, best_fits, times = {}, {}, {}, {}
+        for backend in ('lmfit', 'fast'):
+            set_fitting_backend(backend)
+            exp_fits[backend] = [fit_first_oder_sys_response(x, y) for x, y in fit_windows]
+            linear_fits[backend] = [fit_linear(x, y)[1] for x, y in fit_windows]
+            start = timeit.default_timer()
+            best_fits[backend] = [fit_or_fail(fit_exponential, x, y) for x, y in fit_windows]
+            times[backend] = timeit.default_timer() - start
+        start = timeit.default_timer()
+        windows_per_times = {}  # the windows of a protocol usually share their times, so they are fitted together
+        for x, y in fit_windows:
+            windows_per_times.setdefault((x[0], len(x)), (x, []))[1].append(y)
+        for x, same_times_currents in windows_per_times.values():
+            fit_or_fail(fit_exponential_of_all, x, np.array(same_times_currents))
+        times['fast, all at once'] = timeit.default_timer() - start
+
+        exp_red_chi_difference, exp_red_chi_worsening, exp_curve_difference = compare_fits(exp_fits['lmfit'],
+                                                                                            exp_fits['fast'])
+        same_function = [reference[0] == fit[0] for reference, fit in zip(best_fits['lmfit'], best_fits['fast'])]
+        best_red_chi_difference, _, best_curve_difference = compare_fits(
+            [reference[1] if same else None for reference, same in zip(best_fits['lmfit'], same_function)],
+            [fit[1] for fit in best_fits['fast']])
+        failed_checks = []
+        for i, same in enumerate(same_function):
+            # a sweep right at the threshold may tip either way, the others have to agree
+            improvement_factor = get_improvement_factor(exp_fits['lmfit'][i], linear_fits['lmfit'][i])
+            if not same and abs(improvement_factor - red_chi_significant_improvement_factor) > \
+                    parity_max_red_chi_difference:
+                failed_checks.append('sweep {}: lmfit chose {}, fast chose {}'.format(
+                    i, best_fits['lmfit'][i][0], best_fits['fast'][i][0]))
+        if abs(best_red_chi_difference) > parity_max_red_chi_difference:
+            failed_checks.append('relative red chi difference of the best fits: {:.3g}'.format(best_red_chi_difference))
+        if best_curve_difference > parity_max_curve_difference:
+            failed_checks.append('curve difference of the best fits: {:.3g}'.format(best_curve_difference))
+        if exp_red_chi_worsening > parity_max_red_chi_difference:
+            failed_checks.append('the exponential fits of the fast backend are worse by: {:.3g}'.format(
+                exp_red_chi_worsening))
+        parity[window] = {
+            'same best function': '{}/{}'.format(sum(same_function), len(same_function)),
+            'exponential best function': '{}/{}'.format(sum(fit[0] == 'exponential' for fit in best_fits['fast']),
+                                                        len(same_function)),
+            'relative red chi difference of the exponential fits': exp_red_chi_difference,
+            'curve difference of the exponential fits': exp_curve_difference,
+            'relative red chi difference of the best fits': best_red_chi_difference,
+            'curve difference of the best fits': best_curve_difference,
+            'lmfit [sec]': times['lmfit'], 'fast [sec]': times['fast'],
+            'fast, all at once [sec]': times['fast, all at once'],
+            'failed checks': '; '.join(failed_checks) or 'none'}
+    set_fitting_backend(original_fitting_backend)
+    return parity
+
+
+def print_benchmark(name, results):
+    print(name + ': ' + ', '.join('{} = {}'.format(key, value if isinstance(value, str) else '{:.6g}'.format(value))
+                                  for key, value in results.items()))
+
+
+def main():
+    arguments = sys.argv
+    if len(arguments) in (2, 3) and arguments[1] == '--suite':
+        suite_results = run_suite(arguments[2] if len(arguments) == 3 else None)
+        print('stages of a synthetic recording: ' + json.dumps(suite_results['configuration']))
+        print_benchmark('stages [sec]', suite_results['stages [sec]'])
+        for start, fit_work in suite_results['pre light fit work'].items():
+            print_benchmark('pre light fit work, ' + start, fit_work)
+        return
+    if len(arguments) == 4 and arguments[1] == '--compare':
+        for stage, compared in compare_suite_results(arguments[2], arguments[3]).items():
+            print_benchmark(stage, compared)
+        return
+    if len(arguments) == 2 and arguments[1] == '--startup':
+        for name, command in startup_commands.items():
+            print_benchmark(name, benchmark_startup(command))
+        return
+    if len(arguments) == 3 and arguments[1] == '--parity':  # the parity of the fitting backends on a recorded file
+        abf = import_single_abf(arguments[2])
+        sweeps = [abf.get_sweep(i) for i in range(abf.sweep_count())]
+        print('parity of the fitting backends on {} ({} sweeps)'.format(arguments[2], len(sweeps)))
+    else:
+        sweep = synthetic_sweep()
+        print('synthetic sweep: {} samples at {} Hz'.format(len(sweep.times), synthetic_sample_rate))
+        print_benchmark('linear photocurrent baseline', benchmark_linear_photocurrent_baseline(sweep))
+        sweeps = [synthetic_sweep(seed=seed, drift_tau=drift_tau) for seed in range(3)
+                  for drift_tau in parity_drift_taus]
+        sweeps += [synthetic_sweep(seed=seed, drift_tau=drift_tau, drift_amplitude=drift_amplitude) for seed in range(3)
+                   for drift_amplitude, drift_tau in parity_exponential_drifts]
+        print('parity of the fitting backends on {} synthetic sweeps'.format(len(sweeps)))
+    parity_failed = False
+    for window, parity in check_fitting_backend_parity(sweeps).items():
+        print_benchmark(window + ' fits', parity)
+        parity_failed = parity_failed or parity['failed checks'] != 'none'
+    if parity_failed:
+        print('the fitting backends do not agree')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
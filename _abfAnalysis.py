@@ -1,10 +1,11 @@
-import matplotlib.pyplot as plt
 import pyabf as pyabf
 import numpy as np
 import os
 from pathlib import Path
-from pandas import DataFrame
+from _abfReader import *
 from _fitting import *
+from _fastPlotting import *
+from _profiling import timed, timed_stage
 import logging
 
 ### parameters ###
@@ -12,16 +13,40 @@ photocurrents_ss_duration = 0.5  # [sec] , is the duration of time before the sh
                                     # where steadystate photucurrents are assumed
 plotting_buffer = 0.5            # [sec] , is the duration of time before and after the photocurrents that will be shown in the
                                     # plot
+screen_noise_margin = 3          # a sweep is not fitted if the variance of its noise alone is above this many times
+                                    # red_chi_upper_threshold, as no fit could then get below the threshold
+screen_max_clipped_fraction = 0.01  # a sweep is not fitted if more of the samples that would be fitted are at the
+                                    # highest / lowest current of the recording (i.e. the amplifier was saturated)
 
 ##################
 
 class ActiveAbf:
+    """
+    a recording and the analysis of its sweeps. everything that is per sweep is kept in shared arrays and tables (one
+    time axis, the sweeps' epoch times and input voltages, and a (sweeps x samples) array of the corrected currents
+    per correction), of which the sweep objects are only views. pyabf only reads the header, the samples are read
+    from the memory-mapped data section (see abf_data_reader) where they are used
+    """
+
     def __init__(self, abf_file):
-        self.abf_data = pyabf.ABF(abf_file)
+        self.abf_data = pyabf.ABF(abf_file, loadData=False)
+        self.data_reader = memory_map_abf_data(self.abf_data)
         self._abf_file_path = abf_file
+        self.initialize_sweeps()
+
+    def initialize_sweeps(self):  # called once the abf_data and the data_reader are set
         self._data_points_per_sec = self.abf_data.dataRate
         self._nr_of_sweeps = self.abf_data.sweepCount
-        self.sweep_list = {}
+        self._sweep_times = None
+        self._sweep_epoch_table = None
+        self._sweep_table = None
+        self._channel_labels = {}
+        self._corrected_currents = {}  # correction key -> (sweeps x samples) corrected currents
+        self._corrections = {}  # (correction key, sweep nr) -> the fit of the correction and its corrected currents
+        self._current_corrections = [None] * self._nr_of_sweeps  # the corrected currents and correction type in use
+        self._sweeps = [None] * self._nr_of_sweeps
+        self._correction_screening = None
+        self._fit_warm_starts = {}  # 'pre light' / 'after light' -> the fit_warm_start of the fits of the sweeps
 
     def sweep_count(self):
         return self.abf_data.sweepCount
@@ -32,101 +57,185 @@ class ActiveAbf:
     def get_sweep_input_voltages(self):
         sweep_voltages = {}
         for sweepNumber in range(self._nr_of_sweeps):
-            self.abf_data.setSweep(sweepNumber)
-            sweep_voltages[sweepNumber] = self.abf_data.sweepC[round(len(self.abf_data.sweepC) / 2)]
+            sweep_voltages[sweepNumber] = self.get_sweep_input_voltage(sweepNumber)
         return sweep_voltages
 
-    def get_voltage_changes(self):
-        avg_voltages_and_their_changes = {}
-        nr_of_sweeps = self.sweep_count()
-        for i in range(nr_of_sweeps):
-            avg_sweep_voltages_and_changes = {}
-            sweep_number = nr_of_sweeps - 1 - i
-            sweep_interation = self.get_sweep(sweep_number)
-            sweep_times = sweep_interation.times
-            sweep_voltages = sweep_interation.voltages
-
-            t_light_on = sweep_interation.t_shutter_on
-            t_t_light_on_index = get_index_of_closest_value(t_light_on, sweep_times)
-            avg_voltage_before_light_at_ss = np.average(sweep_voltages[t_t_light_on_index - 10:t_t_light_on_index])
-            avg_sweep_voltages_and_changes['before (at ss)'] = avg_voltage_before_light_at_ss
-
-            t_light_off = sweep_interation.t_shutter_off
-            t_light_off_index = get_index_of_closest_value(t_light_off, sweep_times)
-            t_stst_start = t_light_off - photocurrents_ss_duration
-            t_stst_start_index = get_index_of_closest_value(t_stst_start, sweep_times)
-            avg_voltage_during_light_at_ss = np.average(sweep_voltages[t_stst_start_index:t_light_off_index])
-            voltage_sd_during_light_at_ss = np.std(sweep_voltages[t_stst_start_index:t_light_off_index])
-            avg_sweep_voltages_and_changes['during (at ss)'] = avg_voltage_during_light_at_ss
-            avg_sweep_voltages_and_changes['sd of during (at ss)'] = voltage_sd_during_light_at_ss
-
-            t_clamp_off = sweep_interation.t_clamp_off
-            t_clamp_off_index = get_index_of_closest_value(t_clamp_off, sweep_times)
-            avg_voltage_after_light_at_ss = np.average(sweep_voltages[t_clamp_off_index - 10:t_clamp_off_index])
-            avg_sweep_voltages_and_changes['after (at ss)'] = avg_voltage_after_light_at_ss
-
-            delta_before_and_during_light = abs(avg_voltage_during_light_at_ss - avg_voltage_before_light_at_ss)
-            delta_after_and_during_light = abs(avg_voltage_during_light_at_ss - avg_voltage_after_light_at_ss)
-            avg_sweep_voltages_and_changes['voltage jump'] = abs(
-                delta_before_and_during_light + delta_after_and_during_light) / 2
-            delta_before_and_after_light = abs(avg_voltage_after_light_at_ss - avg_voltage_before_light_at_ss)
-            avg_sweep_voltages_and_changes['voltage drift'] = delta_before_and_after_light
-            avg_voltages_and_their_changes['sweep' + str(sweep_number)] = avg_sweep_voltages_and_changes
-
-        return avg_voltages_and_their_changes
-
-    def get_stst_currents(self):
-        stst_currents = {}
-        nr_of_sweeps = self.sweep_count()
-        for i in range(nr_of_sweeps):
-            sweep_number = nr_of_sweeps - 1 - i
-            sweep_interation = self.get_sweep(sweep_number)
-            assert sweep_interation.currents_are_corrected, "currents are not yet corrected! could not get steady" \
-                                                            " states currents before correction"
-            sweep_times = sweep_interation.times
-            sweep_currents = sweep_interation.currents
-            sweep_t_light_off = sweep_interation.t_shutter_off
-            t_stst_end = sweep_t_light_off
-            t_stst_end_index = get_index_of_closest_value(t_stst_end, sweep_times)
-            t_stst_start = sweep_t_light_off - photocurrents_ss_duration
-            t_stst_start_index = get_index_of_closest_value(t_stst_start, sweep_times)
-            stst_current = np.average(sweep_currents[t_stst_start_index:t_stst_end_index])
-            stst_current_sd = np.std(sweep_currents[t_stst_start_index:t_stst_end_index])
-            stst_currents['sweep' + str(sweep_number)] = {'ss current': stst_current,
-                                                          'ss current sd': stst_current_sd}
-        return stst_currents
-
-    def get_raw_abf_data(self):
-        some_data = {}
+    def get_sweep_input_voltage(self, sweep_num):
+        sweep_command = self.abf_data.stimulusByChannel[0].stimulusWaveform(sweep_num)
+        sweep_command = sweep_command[:self.abf_data.sweepPointCount]
+        return sweep_command[round(len(sweep_command) / 2)]
+
+    def get_sweep_times(self):  # all sweeps of a recording share the same time axis, so it is only built once
+        if self._sweep_times is None:
+            self._sweep_times = np.arange(self.abf_data.sweepPointCount) * self.abf_data.dataSecPerPoint
+        return self._sweep_times
+
+    def get_sweep_table(self):
+        """
+        the epoch times [sec] and the input voltage of all sweeps, built once
+        :return: a structured np array with a row per sweep and the fields 'clamp on', 'shutter on', 'shutter off',
+        'clamp off' and 'input voltage'
+        """
+        if self._sweep_table is None:
+            epoch_starts = np.array([self.get_sweep_epoch_starts(sweep_num)[1:5]
+                                     for sweep_num in range(self._nr_of_sweeps)]).reshape(self._nr_of_sweeps, 4)
+            epoch_times = epoch_starts * self.abf_data.dataSecPerPoint
+            self._sweep_table = to_structured_array({
+                'clamp on': epoch_times[:, 0], 'shutter on': epoch_times[:, 1], 'shutter off': epoch_times[:, 2],
+                'clamp off': epoch_times[:, 3],
+                'input voltage': np.array([self.get_sweep_input_voltage(sweep_num)
+                                           for sweep_num in range(self._nr_of_sweeps)], dtype=float)})
+        return self._sweep_table
+
+    def get_sweep_epoch_starts(self, sweep_num):
+        if self._sweep_epoch_table is None:
+            self._sweep_epoch_table = pyabf.waveform.EpochTable(self.abf_data, 0)
+        return self._sweep_epoch_table.epochWaveformsBySweep[sweep_num].p1s
+
+    def get_sweep_channel_data(self, sweep_num, channel):  # a view into the data section (if it is not scaled)
+        return self.data_reader.get_sweep_data(sweep_num, channel)
+
+    def get_channel_label(self, channel):
+        # as pyabf.ABF.setSweep labels the channel, which would load all of the data
+        if channel not in self._channel_labels:
+            adc_name, adc_units = self.abf_data._getAdcNameAndUnits(channel)
+            self._channel_labels[channel] = {'pA': 'Clamp Current (pA)', 'mV': 'Membrane Potential (mV)'}.get(
+                adc_units, '{} ({})'.format(adc_name, adc_units))
+        return self._channel_labels[channel]
+
+    def get_sweeps_stack(self, channel):  # a (sweeps x samples) view of a channel of all sweeps (if it is not scaled)
+        return self.data_reader.get_sweeps_data(channel)
+
+    def get_corrected_currents_stack(self, first_index=0, last_index=None):
+        """
+        the (sweeps x samples) corrected currents, from first_index to last_index. if all of the sweeps were corrected
+        the same way, this is a view of the stored corrected currents, otherwise only that part of them is copied
+        """
+        assert all(current_correction is not None for current_correction in self._current_corrections), \
+            "currents are not yet corrected! could not get steady states currents before correction"
+        sweeps_corrected_currents = [corrected_currents for corrected_currents, _ in self._current_corrections]
+        for corrected_currents_stack in self._corrected_currents.values():
+            if all(corrected_currents.base is corrected_currents_stack for corrected_currents in sweeps_corrected_currents):
+                return corrected_currents_stack[:, first_index:last_index]
+        return np.array([corrected_currents[first_index:last_index] for corrected_currents in sweeps_corrected_currents])
+
+    def get_stored_correction(self, sweep_num, correction_key):
+        return self._corrections.get((correction_key, sweep_num))
+
+    def store_correction(self, sweep_num, correction_key, correction):
+        # the corrected currents are stored as a row of the (sweeps x samples) array of that correction
+        if correction_key not in self._corrected_currents:
+            self._corrected_currents[correction_key] = np.empty((self._nr_of_sweeps, self.abf_data.sweepPointCount))
+        corrected_currents_stack = self._corrected_currents[correction_key]
+        corrected_currents_stack[sweep_num] = correction['corrected currents']
+        correction['corrected currents'] = corrected_currents_stack[sweep_num]
+        self._corrections[(correction_key, sweep_num)] = correction
+
+    def get_current_correction(self, sweep_num):  # the corrected currents and the correction type, or None
+        return self._current_corrections[sweep_num]
+
+    def get_fit_warm_start(self, fit_name):
+        # consecutive sweeps differ only by their clamp voltage, so each fit starts from the one of the sweep before it
+        if fit_name not in self._fit_warm_starts:
+            self._fit_warm_starts[fit_name] = fit_warm_start()
+        return self._fit_warm_starts[fit_name]
+
+    def get_fit_work(self):  # per fit ('pre light' / 'after light'), how many lmfit fits were done and how much work
+        return {fit_name: warm_start.get_fit_work() for fit_name, warm_start in self._fit_warm_starts.items()}
+
+    def set_corrected_currents(self, sweep_num, corrected_currents, correction_type):
+        assert corrected_currents.shape == (self.abf_data.sweepPointCount,), 'new currents do not have the same ' \
+                                                                             'shape as the previous ones '
+        self._current_corrections[sweep_num] = (corrected_currents, correction_type)
+
+    def get_stst_window_indices(self):
+        # the indices of shutter on, steady state start, shutter off and clamp off of all sweeps (rows)
+        sweep_table = self.get_sweep_table()
+        stst_window_times = np.column_stack([sweep_table['shutter on'],
+                                             sweep_table['shutter off'] - photocurrents_ss_duration,
+                                             sweep_table['shutter off'], sweep_table['clamp off']])
+        return get_indices_of_closest_values(stst_window_times, self.get_sweep_times(), self.abf_data.dataSecPerPoint)
+
+    def get_voltage_statistics(self):
+        """
+        the voltages before, during (at steady state) and after the light of all sweeps, and their changes, computed
+        over the stacked sweeps in a single pass over the chunks of the voltages (see read_chunk_size)
+        :return: a structured np array with a row per sweep
+        """
+        light_on_indices, stst_start_indices, light_off_indices, clamp_off_indices = self.get_stst_window_indices().T
+        first_index = np.min([light_on_indices - 10, stst_start_indices, clamp_off_indices - 10])
+        last_index = np.max([light_on_indices, light_off_indices, clamp_off_indices])
+        (avg_voltages_before_light_at_ss, _), (avg_voltages_during_light_at_ss, voltage_sds_during_light_at_ss), \
+            (avg_voltages_after_light_at_ss, _) = get_chunked_window_statistics(
+                self.data_reader.iter_sweeps_data(1, first_index, last_index),
+                [(light_on_indices - 10, light_on_indices), (stst_start_indices, light_off_indices),
+                 (clamp_off_indices - 10, clamp_off_indices)])
+        voltage_statistics = {'sweep nr': np.arange(self._nr_of_sweeps)}
+        voltage_statistics.update(summarize_voltage_changes(
+            avg_voltages_before_light_at_ss, avg_voltages_during_light_at_ss, voltage_sds_during_light_at_ss,
+            avg_voltages_after_light_at_ss))
+        return to_structured_array(voltage_statistics)
+
+    def get_stst_current_statistics(self):
+        # the same for the (corrected) steady state currents, as a structured np array with a row per sweep
+        _, stst_start_indices, light_off_indices, _ = self.get_stst_window_indices().T
+        corrected_currents_chunks = ((chunk_first_index, self.get_corrected_currents_stack(chunk_first_index,
+                                                                                           chunk_last_index))
+                                     for chunk_first_index, chunk_last_index in iter_index_chunks(
+                                         np.min(stst_start_indices), np.max(light_off_indices), self._nr_of_sweeps))
+        [(stst_currents, stst_current_sds)] = get_chunked_window_statistics(
+            corrected_currents_chunks, [(stst_start_indices, light_off_indices)])
+        return to_structured_array({'sweep nr': np.arange(self._nr_of_sweeps), 'ss current': stst_currents,
+                                    'ss current sd': stst_current_sds})
+
+    def get_voltage_changes(self):  # get_voltage_statistics, as a dictionary per sweep
+        voltage_statistics = self.get_voltage_statistics()
+        return {'sweep' + str(row['sweep nr']): {name: row[name] for name in voltage_statistics.dtype.names[1:]}
+                for row in voltage_statistics[::-1]}
+
+    def get_stst_currents(self):  # get_stst_current_statistics, as a dictionary per sweep
+        stst_current_statistics = self.get_stst_current_statistics()
+        return {'sweep' + str(row['sweep nr']): {'ss current': row['ss current'], 'ss current sd': row['ss current sd']}
+                for row in stst_current_statistics[::-1]}
+
+    def get_epoch_boundary_indices(self):
+        # the indices of clamp on, shutter on, shutter off and clamp off of all sweeps (rows), resolved in one call
+        sweep_table = self.get_sweep_table()
+        epoch_boundaries = np.column_stack([sweep_table['clamp on'], sweep_table['shutter on'],
+                                            sweep_table['shutter off'], sweep_table['clamp off']])
+        return get_indices_of_closest_values(epoch_boundaries, self.get_sweep_times(), self.abf_data.dataSecPerPoint)
+
+    def get_correction_screening(self):  # see screen_sweeps_for_correction, done once
+        if self._correction_screening is None:
+            self._correction_screening = screen_sweeps_for_correction(self)
+        return self._correction_screening
+
+    def get_doomed_sweeps(self):  # sweep nr -> why its correction would fail, of the sweeps that were screened out
+        return {int(row['sweep nr']): str(row['reason']) for row in self.get_correction_screening() if row['reason']}
+
+    def get_raw_abf_data(self):  # a generator, so that only one sweep is read at a time
         for sweepNumber in range(self._nr_of_sweeps):
-            self.abf_data.setSweep(sweepNumber)
-            some_data[sweepNumber] = {
+            yield {
                 'sweep number': sweepNumber,
-                'sweep currents (ADC)': self.abf_data.sweepY,
-                'sweep input voltages (DAC)': self.abf_data.sweepC,
-                'sweep times (seconds)': self.abf_data.sweepX
+                'sweep currents (ADC)': self.get_sweep_channel_data(sweepNumber, 0),
+                'sweep input voltages (DAC)': self.abf_data.stimulusByChannel[0].stimulusWaveform(
+                    sweepNumber)[:self.abf_data.sweepPointCount],
+                'sweep times (seconds)': self.get_sweep_times()
             }
-        return some_data
 
     def get_sweep(self, sweep_num):
-        try:
-            return self.sweep_list['sweep' + str(sweep_num)]
-        except KeyError:
-            return self.create_sweep_obj(sweep_num)
-
-    def create_sweep_obj(self, sweep_num):
-        returned_sweep = sweep(self._abf_file_path, sweep_num)
-        self.sweep_list['sweep' + str(sweep_num)] = returned_sweep
-        return self.sweep_list['sweep' + str(sweep_num)]
+        if self._sweeps[sweep_num] is None:
+            self._sweeps[sweep_num] = sweep(self, sweep_num)
+        return self._sweeps[sweep_num]
 
     def make_output_folder(self):
-        analysis_results_folder = Path(str(Path(self.which_abf_file()).parent) + '/analysis_results/')
-        Path.mkdir(analysis_results_folder, exist_ok=True)
-        return analysis_results_folder
+        return make_analysis_results_folder(self.which_abf_file())
 
+    @timed('csv export')
     def export_analyzed_abf_data_to_csv(self):
+        from pandas import DataFrame  # pandas (like matplotlib and lmfit) is only imported where it is needed
         name_of_abf = Path(self.which_abf_file()).stem
-        currents_data = {"00_sweep_time_point[sec]": self.sweep_list["sweep0"].times}
+        currents_data = {"00_sweep_time_point[sec]": self.get_sweep_times()}
         for i in range(self._nr_of_sweeps):
             sweep_in_abf = self.get_sweep(i)
             col_index_uncorrected = 1+2*i
@@ -142,52 +251,133 @@ class ActiveAbf:
         output_folder = self.make_output_folder()
         currents_df.to_csv(str(output_folder) + '/' + str(name_of_abf) + '_currents.csv', index=None, header=True)
 
-        stst_currents = self.get_stst_currents()
-        voltage_changes = self.get_voltage_changes()
+        sweeps_df = DataFrame(self.get_sweeps_summary())
+        sweeps_df.to_csv(str(output_folder) + '/' + str(name_of_abf) + '_sweeps.csv', index=None, header=True)
+
+    def get_sweeps_summary(self):
+        stst_current_statistics = self.get_stst_current_statistics()
+        voltage_statistics = self.get_voltage_statistics()
         sweeps_data = {"0_sweep_nr": np.array([str(i) for i in range(self._nr_of_sweeps)]),
                        "1_input_voltage[mV]": np.array(
-                           [self.get_sweep(i).input_voltage for i in range(self._nr_of_sweeps)]),
-                       "2_currents_during_light_at_steadystate[nA]": np.array(
-                           [stst_currents["sweep" + str(i)]['ss current'] for i in range(self._nr_of_sweeps)]),
-                       "3_SD_of_currents_during_light_at_steadystate[nA]": np.array(
-                           [stst_currents["sweep" + str(i)]['ss current sd'] for i in range(self._nr_of_sweeps)]),
-                       "4_voltage_during_light_at_steadystate[mV]": np.array(
-                           [voltage_changes["sweep" + str(i)]['during (at ss)'] for i in range(self._nr_of_sweeps)]),
-                       "5_SD_of_voltage_during_light_at_steadystate[mV]": np.array(
-                           [voltage_changes["sweep" + str(i)]['sd of during (at ss)'] for i in range(self._nr_of_sweeps)]),
-                       "6_voltage_jump[mV]": np.array(
-                           [voltage_changes["sweep" + str(i)]['voltage jump'] for i in range(self._nr_of_sweeps)]),
-                       "7_voltage_drift[mV]": np.array(
-                           [voltage_changes["sweep" + str(i)]['voltage drift'] for i in range(self._nr_of_sweeps)])}
-        sweeps_df = DataFrame(sweeps_data, columns=sorted(sweeps_data.keys()))
+                           self.get_sweep_table()['input voltage']),
+                       "2_currents_during_light_at_steadystate[nA]": stst_current_statistics['ss current'],
+                       "3_SD_of_currents_during_light_at_steadystate[nA]": stst_current_statistics['ss current sd'],
+                       "4_voltage_during_light_at_steadystate[mV]": voltage_statistics['during (at ss)'],
+                       "5_SD_of_voltage_during_light_at_steadystate[mV]": voltage_statistics['sd of during (at ss)'],
+                       "6_voltage_jump[mV]": voltage_statistics['voltage jump'],
+                       "7_voltage_drift[mV]": voltage_statistics['voltage drift']}
+        return {column: sweeps_data[column] for column in sorted(sweeps_data.keys())}
+
+    @timed('npz export')
+    def export_analyzed_abf_data_to_npz(self, use_float32=False, compressed=True):
+        """
+        exports the analyzed data as a binary, columnar .npz file (the counterpart of the .csv files), which can be
+        loaded with import_analyzed_abf_data_from_npz
+        :param use_float32: whether to store the arrays as float32 instead of float64, which halves the file size
+        :param compressed: whether to compress the file
+        """
+        name_of_abf = Path(self.which_abf_file()).stem
+        dtype = np.float32 if use_float32 else np.float64
+        sweeps = [self.get_sweep(i) for i in range(self._nr_of_sweeps)]
+        analyzed_data = {
+            'times': np.asarray(sweeps[0].times, dtype=dtype),
+            'uncorrected currents': np.array([sweep_in_abf.original_currents for sweep_in_abf in sweeps], dtype=dtype),
+            'corrected currents': np.array([sweep_in_abf.currents for sweep_in_abf in sweeps], dtype=dtype),
+            'voltages': np.array([sweep_in_abf.voltages for sweep_in_abf in sweeps], dtype=dtype)}
+        for column, values in self.get_sweeps_summary().items():
+            analyzed_data['sweeps/' + column] = values if values.dtype.kind == 'U' else values.astype(dtype)
+        output_folder = self.make_output_folder()
+        save_npz = np.savez_compressed if compressed else np.savez
+        save_npz(str(output_folder) + '/' + str(name_of_abf) + '_analyzed.npz', **analyzed_data)
+
+
+class sweep:
+    """
+    a lightweight view of a single sweep of its parent ActiveAbf, which holds the data, the epoch times and the corrected
+    currents of all sweeps. nothing but the sweep number is stored per sweep, everything else is looked up when accessed
+    """
+    __slots__ = ('_active_abf', 'sweep_nr')
+    input_voltage_title = 'Digital Input Clamp Voltage (mV)'
+    shutter_title = 'Shutter Voltage (V)'
+    times_title = 'Time (seconds)'  # as pyabf labels the times
+
+    def __init__(self, active_abf, sweep_nr):
+        self._active_abf = active_abf
+        self.sweep_nr = sweep_nr
 
-        sweeps_df.to_csv(str(output_folder) + '/' + str(name_of_abf) + '_sweeps.csv', index=None, header=True)
+    @property
+    def abf_data(self):
+        return self._active_abf.abf_data
 
+    @property
+    def t_clamp_on(self):
+        return float(self._active_abf.get_sweep_table()['clamp on'][self.sweep_nr])
 
-class sweep(ActiveAbf):
-    def __init__(self, abf_file, sweep_nr):
-        super().__init__(abf_file)
-        self.abf_data.setSweep(sweep_nr)
-        self.sweep_nr = sweep_nr
-        self.t_clamp_on = self.abf_data.sweepEpochs.p1s[1] * self.abf_data.dataSecPerPoint
-        self.t_shutter_on = self.abf_data.sweepEpochs.p1s[2] * self.abf_data.dataSecPerPoint
-        self.t_shutter_off = self.abf_data.sweepEpochs.p1s[3] * self.abf_data.dataSecPerPoint
-        self.t_clamp_off = self.abf_data.sweepEpochs.p1s[4] * self.abf_data.dataSecPerPoint
-        self.original_currents = self.abf_data.sweepY
-        self.currents_are_corrected = False
-        self.correction_type = None
-        self.currents = self.abf_data.sweepY
-        self.currents_title = self.abf_data.sweepLabelY
-        self.times = self.abf_data.sweepX
-        self.times_title = self.abf_data.sweepLabelX.capitalize()
-        self.input_voltage = self.abf_data.sweepC[round(len(self.abf_data.sweepC) / 2)]
-        self.input_voltage_title = 'Digital Input Clamp Voltage (mV)'
-        self.abf_data.setSweep(sweep_nr, 1)
-        self.voltages = self.abf_data.sweepY
-        self.voltages_title = self.abf_data.sweepLabelY
-        self.abf_data.setSweep(sweep_nr, 2)
-        self.shutter = self.abf_data.sweepY
-        self.shutter_title = 'Shutter Voltage (V)'
+    @property
+    def t_shutter_on(self):
+        return float(self._active_abf.get_sweep_table()['shutter on'][self.sweep_nr])
+
+    @property
+    def t_shutter_off(self):
+        return float(self._active_abf.get_sweep_table()['shutter off'][self.sweep_nr])
+
+    @property
+    def t_clamp_off(self):
+        return float(self._active_abf.get_sweep_table()['clamp off'][self.sweep_nr])
+
+    @property
+    def input_voltage(self):
+        return self._active_abf.get_sweep_table()['input voltage'][self.sweep_nr]
+
+    @property
+    def times(self):
+        return self._active_abf.get_sweep_times()
+
+    @property
+    def sample_interval(self):
+        return self._active_abf.abf_data.dataSecPerPoint
+
+    @property
+    def currents_title(self):
+        return self._active_abf.get_channel_label(0)
+
+    @property
+    def voltages_title(self):
+        return self._active_abf.get_channel_label(1)
+
+    @property
+    def currents_are_corrected(self):
+        return self._active_abf.get_current_correction(self.sweep_nr) is not None
+
+    @property
+    def correction_type(self):
+        current_correction = self._active_abf.get_current_correction(self.sweep_nr)
+        return None if current_correction is None else current_correction[1]
+
+    @property
+    def original_currents(self):
+        return self._active_abf.get_sweep_channel_data(self.sweep_nr, 0)
+
+    @property
+    def currents(self):
+        current_correction = self._active_abf.get_current_correction(self.sweep_nr)
+        if current_correction is None:
+            return self.original_currents
+        return current_correction[0]
+
+    @property
+    def voltages(self):
+        return self._active_abf.get_sweep_channel_data(self.sweep_nr, 1)
+
+    @property
+    def shutter(self):
+        return self._active_abf.get_sweep_channel_data(self.sweep_nr, 2)
+
+    def which_abf_file(self):
+        return self._active_abf.which_abf_file()
+
+    def make_output_folder(self):
+        return self._active_abf.make_output_folder()
 
     def get_sweep_data(self):
         return {
@@ -208,33 +398,175 @@ class sweep(ActiveAbf):
             'input clamp voltage title': self.input_voltage_title
         }
 
+    def get_stored_correction(self, correction_key):
+        return self._active_abf.get_stored_correction(self.sweep_nr, correction_key)
+
+    def store_correction(self, correction_key, correction):
+        self._active_abf.store_correction(self.sweep_nr, correction_key, correction)
+
     def set_corrected_currents(self, corrected_currents, correction_type):
-        assert corrected_currents.shape == self.currents.shape, 'new currents do not have the same shape as the ' \
-                                                                'previous ones '
-        self.currents = corrected_currents
-        self.currents_are_corrected = True
-        self.correction_type = correction_type
+        self._active_abf.set_corrected_currents(self.sweep_nr, corrected_currents, correction_type)
+
+    def get_fit_warm_start(self, fit_name):
+        return self._active_abf.get_fit_warm_start(fit_name)
 
 
-def correct_current_via_pre_light_fit(sweep, initial_function='exponential'):
-    sweep_times = sweep.times
-    sweep_currents = sweep.currents
-    best_function, pre_light_fit_result = fit_pre_light(sweep, initial_function)
-    pre_light_fit_baseline = estimate_data_with_fit(sweep_times, best_function, pre_light_fit_result)
-    baseline_corrected_currents = sweep_currents - pre_light_fit_baseline
-    sweep.set_corrected_currents(baseline_corrected_currents, 'pre_light_only')
-    return baseline_corrected_currents
+def summarize_voltage_changes(avg_voltage_before_light_at_ss, avg_voltage_during_light_at_ss,
+                              voltage_sd_during_light_at_ss, avg_voltage_after_light_at_ss):
+    avg_sweep_voltages_and_changes = {'before (at ss)': avg_voltage_before_light_at_ss,
+                                      'during (at ss)': avg_voltage_during_light_at_ss,
+                                      'sd of during (at ss)': voltage_sd_during_light_at_ss,
+                                      'after (at ss)': avg_voltage_after_light_at_ss}
+    delta_before_and_during_light = abs(avg_voltage_during_light_at_ss - avg_voltage_before_light_at_ss)
+    delta_after_and_during_light = abs(avg_voltage_during_light_at_ss - avg_voltage_after_light_at_ss)
+    avg_sweep_voltages_and_changes['voltage jump'] = abs(
+        delta_before_and_during_light + delta_after_and_during_light) / 2
+    delta_before_and_after_light = abs(avg_voltage_after_light_at_ss - avg_voltage_before_light_at_ss)
+    avg_sweep_voltages_and_changes['voltage drift'] = delta_before_and_after_light
+    return avg_sweep_voltages_and_changes
+
+
+def get_analysis_parameters():  # the parameters that change the outputs of an analysis, e.g. to tell if they are outdated
+    analysis_parameters = {'photocurrents_ss_duration': photocurrents_ss_duration,
+                           'plotting_buffer': plotting_buffer, 'screen_noise_margin': screen_noise_margin,
+                           'screen_max_clipped_fraction': screen_max_clipped_fraction}
+    analysis_parameters.update(get_fit_parameters())
+    return analysis_parameters
+
+
+def make_analysis_results_folder(abf_file):
+    analysis_results_folder = Path(str(Path(abf_file).parent) + '/analysis_results/')
+    Path.mkdir(analysis_results_folder, exist_ok=True)
+    return analysis_results_folder
+
+
+def get_correction_key(correction_type, *fit_functions):
+    # a correction is only reused if it was done the same way and with the same fit parameters
+    return (correction_type,) + fit_functions + tuple(sorted(get_fit_parameters().items()))
+
+
+def correct_current_via_pre_light_fit(sweep, initial_function='exponential', pre_light_fit=None):
+    correction_key = get_correction_key('pre_light_only', initial_function)
+    correction = sweep.get_stored_correction(correction_key)
+    if correction is None:
+        with timed_stage('pre light correction', sweep.sweep_nr):
+            if pre_light_fit is None:
+                pre_light_fit = fit_pre_light(sweep, initial_function,
+                                              warm_start=sweep.get_fit_warm_start('pre light'))
+            best_function, pre_light_fit_result = pre_light_fit
+            pre_light_fit_baseline = estimate_data_with_fit(sweep.times, best_function, pre_light_fit_result)
+            correction = {'best function': best_function,
+                          'fit result': pre_light_fit_result,
+                          'corrected currents': sweep.original_currents - pre_light_fit_baseline}
+        sweep.store_correction(correction_key, correction)
+    sweep.set_corrected_currents(correction['corrected currents'], 'pre_light_only')
+    return correction['corrected currents']
 
 
 def correct_current_via_linear_baseline(sweep, initial_function_pre_light='exponential',
-                                        initial_function_after_light='exponential'):
-    correct_current_via_pre_light_fit(sweep, initial_function=initial_function_pre_light)
-    linear_light_baseline = calculate_linear_photocurrent_baseline(sweep,
-                                                                   fit_after_function=initial_function_after_light)
-    sweep_currents = sweep.currents
-    baseline_corrected_currents = sweep_currents - linear_light_baseline
-    sweep.set_corrected_currents(baseline_corrected_currents, 'pre_and_after_light')
-    return baseline_corrected_currents
+                                        initial_function_after_light='exponential', after_light_fit=None):
+    correction_key = get_correction_key('pre_and_after_light', initial_function_pre_light,
+                                        initial_function_after_light)
+    correction = sweep.get_stored_correction(correction_key)
+    if correction is None:
+        with timed_stage('pre and after light correction', sweep.sweep_nr):
+            pre_light_corrected_currents = correct_current_via_pre_light_fit(
+                sweep, initial_function=initial_function_pre_light)
+            linear_light_baseline, after_light_fit = calculate_linear_photocurrent_baseline(
+                sweep, fit_after_function=initial_function_after_light, return_after_light_fit=True,
+                after_light_fit=after_light_fit, warm_start=sweep.get_fit_warm_start('after light'))
+            correction = {'best function': after_light_fit[0],
+                          'fit result': after_light_fit[1],
+                          'corrected currents': pre_light_corrected_currents - linear_light_baseline}
+        sweep.store_correction(correction_key, correction)
+    sweep.set_corrected_currents(correction['corrected currents'], 'pre_and_after_light')
+    return correction['corrected currents']
+
+
+@timed('correction screening')
+def screen_sweeps_for_correction(active_abf):
+    """
+    checks all sweeps at once, before any fit, for what would make their correction fail anyway: epochs without room
+    for the pre-light or the after-light fit (e.g. missing shutter edges), a saturated amplifier, or more noise than a
+    fit below red_chi_upper_threshold allows. the drift is only reported, as the baseline fits take it out
+    :return: a structured np array with a row per sweep, of which 'reason' is empty for the sweeps that can be fitted
+    """
+    sweep_table = active_abf.get_sweep_table()
+    sweep_times = active_abf.get_sweep_times()
+    sample_interval = active_abf.abf_data.dataSecPerPoint
+    fit_window_times = np.column_stack([sweep_table['shutter on'] - default_start_of_pre_light_fit,
+                                        sweep_table['shutter on'],
+                                        sweep_table['shutter off'] + default_assumed_t_ss,
+                                        sweep_table['clamp off'] - 0.01])
+    has_fit_windows = ((sweep_table['clamp on'] < fit_window_times[:, 0])
+                       & (sweep_table['shutter on'] < sweep_table['shutter off'])
+                       & (fit_window_times[:, 2] < sweep_table['clamp off'])
+                       & (fit_window_times[:, 3] <= sweep_times[-1]))
+    fit_window_indices = get_indices_of_closest_values(np.clip(fit_window_times, sweep_times[0], sweep_times[-1]),
+                                                       sweep_times, sample_interval)
+    # the sweeps without fit windows get a dummy one, so that all sweeps are screened at once
+    fit_window_indices[~has_fit_windows] = [0, 2, 2, 4]
+    fit_window_indices[:, 1::2] = np.maximum(fit_window_indices[:, 1::2], fit_window_indices[:, ::2] + 2)
+    currents_stack = active_abf.get_sweeps_stack(0)
+    noise_sds = np.maximum(get_window_noise(currents_stack, fit_window_indices[:, 0], fit_window_indices[:, 1]),
+                           get_window_noise(currents_stack, fit_window_indices[:, 2], fit_window_indices[:, 3]))
+    pre_light_currents, _ = get_window_statistics(currents_stack, fit_window_indices[:, 0], fit_window_indices[:, 1])
+    after_light_currents, _ = get_window_statistics(currents_stack, fit_window_indices[:, 2], fit_window_indices[:, 3])
+    drifts = (after_light_currents - pre_light_currents) / (
+        np.mean(fit_window_indices[:, 2:], axis=1) - np.mean(fit_window_indices[:, :2], axis=1)) / sample_interval
+    is_clipped = (currents_stack == np.max(currents_stack)) | (currents_stack == np.min(currents_stack))
+    pre_light_clipped_fractions, _ = get_window_statistics(is_clipped, fit_window_indices[:, 0], fit_window_indices[:, 1])
+    after_light_clipped_fractions, _ = get_window_statistics(is_clipped, fit_window_indices[:, 2],
+                                                             fit_window_indices[:, 3])
+    clipped_fractions = np.maximum(pre_light_clipped_fractions, after_light_clipped_fractions)
+    reasons = np.where(~has_fit_windows, 'no room for the fits between the clamp and shutter epochs',
+                       np.where(clipped_fractions > screen_max_clipped_fraction, 'the currents are clipped',
+                                np.where(noise_sds ** 2 > screen_noise_margin * red_chi_upper_threshold,
+                                         'the currents are too noisy', '')))
+    correction_screening = to_structured_array({
+        'sweep nr': np.arange(active_abf.sweep_count()), 'noise sd': noise_sds, 'drift': drifts,
+        'clipped fraction': clipped_fractions, 'reason': reasons})
+    for row in correction_screening[correction_screening['reason'] != '']:
+        logging.error('sweep {} will not be corrected, as {} (noise sd = {:.3g}, drift = {:.3g} / sec, clipped = '
+                      '{:.1%})'.format(row['sweep nr'], row['reason'], row['noise sd'], row['drift'],
+                                       row['clipped fraction']))
+    return correction_screening
+
+
+def correct_all_sweeps(active_abf, correction):
+    # the sweeps are screened first, so that a file that could not be corrected anyway is not fitted at all. with the
+    # fast fitting backend, the fits of all sweeps are solved at once before the sweeps are corrected, and with a
+    # sweep pool (see set_sweep_workers), they are solved in its processes and merged back in sweep order. otherwise,
+    # the sweeps are fitted one after the other, last one first, each fit warm started from the one before it
+    if active_abf.get_doomed_sweeps():
+        raise AssertionError('sweeps ' + str(sorted(active_abf.get_doomed_sweeps())) + ' could not be corrected')
+    nr_of_sweeps = active_abf.sweep_count()
+    sweeps = [active_abf.get_sweep(nr_of_sweeps - 1 - i) for i in range(nr_of_sweeps)]
+    if get_fitting_backend() == 'fast' or get_sweep_pool() is not None:
+        uncorrected_sweeps = [sweep_i for sweep_i in sweeps if
+                              sweep_i.get_stored_correction(get_correction_key('pre_light_only', 'exponential')) is None]
+        if uncorrected_sweeps:
+            for sweep_i, pre_light_fit in zip(uncorrected_sweeps,
+                                              fit_pre_light_of_sweeps(uncorrected_sweeps, 'exponential')):
+                correct_current_via_pre_light_fit(sweep_i, pre_light_fit=pre_light_fit)
+        if correction == 'pre_and_after_light':
+            uncorrected_sweeps = [sweep_i for sweep_i in sweeps if sweep_i.get_stored_correction(
+                get_correction_key('pre_and_after_light', 'exponential', 'exponential')) is None]
+            for sweep_i in uncorrected_sweeps:
+                correct_current_via_pre_light_fit(sweep_i)
+            if uncorrected_sweeps:
+                for sweep_i, after_light_fit in zip(uncorrected_sweeps,
+                                                    fit_after_light_of_sweeps(uncorrected_sweeps, 'exponential')):
+                    correct_current_via_linear_baseline(sweep_i, after_light_fit=after_light_fit)
+    fit_work_before = active_abf.get_fit_work()
+    corrected_currents = [correct_currents(sweep_i, correction) for sweep_i in sweeps]
+    for fit_name, fit_work in active_abf.get_fit_work().items():
+        fit_work = {work: count - fit_work_before.get(fit_name, {}).get(work, 0) for work, count in fit_work.items()}
+        if fit_work['fits']:
+            logging.info('{} fits: {} ({} warm started, {} of which failed), {} function evaluations'.format(
+                fit_name, fit_work['fits'], fit_work['warm started fits'], fit_work['failed warm starts'],
+                fit_work['function evaluations']))
+    return corrected_currents
 
 
 def auto_interval_to_plot(sweep):
@@ -244,8 +576,8 @@ def auto_interval_to_plot(sweep):
         t_start = sweep.t_shutter_on - plotting_buffer/2
         t_end = sweep.t_shutter_off + plotting_buffer/2
 
-    first_element = get_index_of_closest_value(t_start, sweep.times)
-    last_element = get_index_of_closest_value(t_end, sweep.times)
+    first_element = get_index_of_closest_value(t_start, sweep.times, sweep.sample_interval)
+    last_element = get_index_of_closest_value(t_end, sweep.times, sweep.sample_interval)
     return first_element, last_element
 
 
@@ -260,7 +592,22 @@ def correct_currents(sweep, correction):
     return corrected_currents
 
 
-def plot_sweep(sweep, show_plot=False, plot_interval=None, correction=None, save_fig=False, specified_y_plot_range=None):
+def get_sweep_plot_path(sweep):  # without the file extension
+    return str(sweep.make_output_folder()) + '/' + str(Path(sweep.which_abf_file()).stem) + '_sweep_' + str(
+        sweep.sweep_nr) + '_plot'
+
+
+def get_all_sweeps_plot_path(active_abf, correction=None):  # without the file extension
+    plot_path = str(active_abf.make_output_folder()) + '/' + str(Path(active_abf.which_abf_file()).stem)
+    if correction is None:
+        return plot_path + '_all_sweeps_not_corrected_plot'
+    return plot_path + '_all_sweeps_corrected_' + correction + '_plot'
+
+
+@timed('sweep plot')
+def plot_sweep(sweep, show_plot=False, plot_interval=None, correction=None, save_fig=False, specified_y_plot_range=None,
+               renderer=None):
+    # with a renderer (see _fastPlotting), a saved plot is decimated and rendered by it instead of being drawn here
     if plot_interval is None:
         plot_interval = auto_interval_to_plot(sweep)
     else:
@@ -274,6 +621,14 @@ def plot_sweep(sweep, show_plot=False, plot_interval=None, correction=None, save
     else:
         logging.error('corrected should be None / pre_light_only / pre_and_after_light. Is, however, ' + correction)
         raise ValueError
+    if renderer is not None and save_fig and not show_plot:
+        renderer.submit(make_sweep_plot_job(
+            get_sweep_plot_path(sweep), sweep_time[plot_interval[0]:plot_interval[1]],
+            sweep_current[plot_interval[0]:plot_interval[1]], sweep_voltage[plot_interval[0]:plot_interval[1]],
+            sweep.times_title, sweep.currents_title, sweep.voltages_title, sweep.t_shutter_on, sweep.t_shutter_off,
+            specified_y_plot_range))
+        return
+    import matplotlib.pyplot as plt
     fig, axs = plt.subplots(2)
     axs[0].plot(sweep_time[plot_interval[0]:plot_interval[1]], sweep_current[plot_interval[0]:plot_interval[1]])
     axs[0].set(xlabel=sweep.times_title, ylabel=sweep.currents_title)
@@ -291,20 +646,25 @@ def plot_sweep(sweep, show_plot=False, plot_interval=None, correction=None, save
         plt.show()
 
     if save_fig:
-        sweep_path = Path(sweep.which_abf_file())
-        analysis_results_folder = sweep.make_output_folder()
-        fig.savefig(
-            str(analysis_results_folder) + '/' + str(sweep_path.stem) + '_sweep_' + str(sweep.sweep_nr) + '_plot.pdf')
+        fig.savefig(get_sweep_plot_path(sweep) + '.pdf')
         plt.close()
 
 
-def plot_all_sweeps(active_abf, show_plot=False, plot_interval=None, correction=None, save_fig=False, specified_y_plot_range=None):
+@timed('all sweeps plot')
+def plot_all_sweeps(active_abf, show_plot=False, plot_interval=None, correction=None, save_fig=False, specified_y_plot_range=None,
+                    renderer=None):
     if plot_interval is None:
         first_sweep = active_abf.get_sweep(0)
         plot_interval = auto_interval_to_plot(first_sweep)
     else:
         assert (type(plot_interval) == list and len(plot_interval) == 2)
     nr_of_sweeps = active_abf.sweep_count()
+    if correction is not None:
+        correct_all_sweeps(active_abf, correction)
+    if renderer is not None and save_fig and not show_plot:
+        renderer.submit(make_all_sweeps_plot_job_of_abf(active_abf, plot_interval, correction, specified_y_plot_range))
+        return
+    import matplotlib.pyplot as plt
     fig, ax = plt.subplots(1)
     for i in range(nr_of_sweeps):
         sweep_number = nr_of_sweeps - 1 - i
@@ -319,7 +679,6 @@ def plot_all_sweeps(active_abf, show_plot=False, plot_interval=None, correction=
             raise ValueError
         ax.plot(time[plot_interval[0]:plot_interval[1]], current[plot_interval[0]:plot_interval[1]], alpha=.5,
                 label="{} mV".format(sweep_interation.input_voltage))
-        ax.legend(loc='upper left', prop={'size': 8})
         if sweep_number == 0:
             ax.set(xlabel=sweep_interation.times_title, ylabel=sweep_interation.currents_title)
             ax.label_outer()  # Hide x labels and tick labels for top plots and y ticks for right plots.
@@ -327,15 +686,79 @@ def plot_all_sweeps(active_abf, show_plot=False, plot_interval=None, correction=
             ax.axvspan(sweep_interation.t_shutter_on, sweep_interation.t_shutter_off, color='orange', alpha=.3, lw=0)
         if specified_y_plot_range:
             ax.set_ylim([specified_y_plot_range[0],specified_y_plot_range[1]])
+    ax.legend(loc='upper left', prop={'size': 8})
     if show_plot:
         plt.show()
 
     if save_fig:
-        abf_path = Path(active_abf.which_abf_file())
-        analysis_results_folder = active_abf.make_output_folder()
+        fig.savefig(get_all_sweeps_plot_path(active_abf, correction) + '.pdf')
+        plt.close()
+
+
+def get_report_path(active_abf):
+    return str(active_abf.make_output_folder()) + '/' + str(Path(active_abf.which_abf_file()).stem) + '_report.pdf'
+
+
+@timed('report plots')
+def plot_report(active_abf, report_writer, corrections=('pre_and_after_light',), plot_sweeps=False,
+                plot_uncorrected=False, specified_y_plot_range=None):
+    """
+    plots an abf file into its report in a single pass over the sweeps: a page per sweep (if plot_sweeps), followed by
+    the all-sweep plots, uncorrected (if plot_uncorrected) and per correction. nothing is plotted if a correction fails
+    :param report_writer: where the plots go, e.g. a pdf_report_writer (or a plot_renderer)
+    :param corrections: the corrections of the all-sweep plots, in order, the last one being kept for the export
+    """
+    first_sweep = active_abf.get_sweep(0)
+    plot_interval = auto_interval_to_plot(first_sweep)
+    for correction in corrections:
+        correct_all_sweeps(active_abf, correction)
+    all_sweeps_plots = ([None] if plot_uncorrected else []) + list(corrections)
+    all_sweeps_traces = {all_sweeps_plot: [] for all_sweeps_plot in all_sweeps_plots}
+    legend_labels = []
+    plot_jobs = []
+    for sweep_number in range(active_abf.sweep_count()):
+        sweep_interation = active_abf.get_sweep(sweep_number)
+        time = sweep_interation.times
+        if plot_sweeps:
+            sweep_interval = auto_interval_to_plot(sweep_interation)
+            plot_jobs.append(make_sweep_plot_job(
+                get_sweep_plot_path(sweep_interation), time[sweep_interval[0]:sweep_interval[1]],
+                sweep_interation.original_currents[sweep_interval[0]:sweep_interval[1]],
+                sweep_interation.voltages[sweep_interval[0]:sweep_interval[1]], sweep_interation.times_title,
+                sweep_interation.currents_title, sweep_interation.voltages_title, sweep_interation.t_shutter_on,
+                sweep_interation.t_shutter_off, specified_y_plot_range))
+        for all_sweeps_plot in all_sweeps_plots:
+            if all_sweeps_plot is None:
+                current = sweep_interation.original_currents
+            else:
+                current = correct_currents(sweep_interation, all_sweeps_plot)
+            all_sweeps_traces[all_sweeps_plot].append((time[plot_interval[0]:plot_interval[1]],
+                                                       current[plot_interval[0]:plot_interval[1]]))
+        legend_labels.append("{} mV".format(sweep_interation.input_voltage))
+    for all_sweeps_plot in all_sweeps_plots:  # from the last sweep to the first, as in plot_all_sweeps
+        plot_jobs.append(make_all_sweeps_plot_job(
+            get_all_sweeps_plot_path(active_abf, all_sweeps_plot), all_sweeps_traces[all_sweeps_plot][::-1],
+            legend_labels[::-1], first_sweep.times_title, first_sweep.currents_title, first_sweep.t_shutter_on,
+            first_sweep.t_shutter_off, specified_y_plot_range))
+    for plot_job in plot_jobs:
+        report_writer.submit(plot_job)
+
+
+def make_all_sweeps_plot_job_of_abf(active_abf, plot_interval, correction=None, specified_y_plot_range=None):
+    nr_of_sweeps = active_abf.sweep_count()
+    traces = []
+    legend_labels = []
+    for i in range(nr_of_sweeps):
+        sweep_number = nr_of_sweeps - 1 - i
+        sweep_interation = active_abf.get_sweep(sweep_number)
         if correction is None:
-            fig.savefig(str(analysis_results_folder) + '/' + str(abf_path.stem) + '_all_sweeps_not_corrected_plot.pdf')
+            current = sweep_interation.currents
         else:
-            fig.savefig(str(analysis_results_folder) + '/' + str(
-                abf_path.stem) + '_all_sweeps_corrected_' + correction + '_plot.pdf')
-        plt.close()
+            current = correct_currents(sweep_interation, correction)
+        traces.append((sweep_interation.times[plot_interval[0]:plot_interval[1]],
+                       current[plot_interval[0]:plot_interval[1]]))
+        legend_labels.append("{} mV".format(sweep_interation.input_voltage))
+    first_sweep = active_abf.get_sweep(0)
+    return make_all_sweeps_plot_job(get_all_sweeps_plot_path(active_abf, correction), traces, legend_labels,
+                                    first_sweep.times_title, first_sweep.currents_title, first_sweep.t_shutter_on,
+                                    first_sweep.t_shutter_off, specified_y_plot_range)
@@ -0,0 +1,83 @@
+import numpy as np
+
+### parameters ###
+read_chunk_size = 2 ** 22  # [samples] , the number of samples (of all sweeps together) that a chunked pass reads at once
+
+##################
+
+
+class abf_data_reader:
+    """
+    the samples of a recording, laid out as in the data section of an .abf file (samples x channels), of which only the
+    parts that are accessed are read and scaled. with a memory-mapped data section (see memory_map_abf_data), a long or
+    gap-free recording is never held in memory as a whole
+    """
+
+    def __init__(self, raw_data, nr_of_sweeps, sweep_point_count, data_gains=None, data_offsets=None):
+        """
+        :param raw_data: a (samples x channels) np array, e.g. an np.memmap of the data section
+        :param data_gains: None if the raw data is already in the units of each channel, otherwise the gain of each
+        channel, by which (and then by its data_offsets) the raw data is scaled, as pyabf scales int16 data
+        """
+        self._raw_data = raw_data
+        self._nr_of_sweeps = nr_of_sweeps
+        self._sweep_point_count = sweep_point_count
+        self._data_gains = data_gains
+        self._data_offsets = data_offsets
+
+    def scale(self, channel, raw_data):
+        if self._data_gains is None:
+            return raw_data
+        return np.add(np.multiply(raw_data.astype(np.float32), self._data_gains[channel]), self._data_offsets[channel])
+
+    def get_sweeps_data(self, channel, first_index=0, last_index=None):
+        """
+        the (sweeps x samples) data of a channel, from first_index to last_index of each sweep. raw float data is
+        returned as a view of the data section (nothing is read before it is accessed), int16 data is read and scaled
+        """
+        channel_data = self._raw_data[:self._nr_of_sweeps * self._sweep_point_count, channel]
+        return self.scale(channel, channel_data.reshape(self._nr_of_sweeps, self._sweep_point_count)[
+                                   :, first_index:last_index])
+
+    def get_sweep_data(self, sweep_nr, channel):
+        first_point = self._sweep_point_count * sweep_nr
+        return self.scale(channel, self._raw_data[first_point:first_point + self._sweep_point_count, channel])
+
+    def iter_sweeps_data(self, channel, first_index=0, last_index=None, chunk_size=read_chunk_size):
+        # get_sweeps_data in chunks of the samples, see iter_index_chunks
+        for chunk_first_index, chunk_last_index in iter_index_chunks(
+                first_index, self._sweep_point_count if last_index is None else last_index, self._nr_of_sweeps,
+                chunk_size):
+            yield chunk_first_index, self.get_sweeps_data(channel, chunk_first_index, chunk_last_index)
+
+    def read_ahead(self, chunk_size=read_chunk_size):
+        # reads the whole data section once, a chunk at a time, so that the system has it cached (e.g. from a network
+        # drive) by the time it is analyzed, without it being held in the memory of this process
+        samples_per_chunk = max(1, chunk_size // self._raw_data.shape[1])
+        for first_point in range(0, len(self._raw_data), samples_per_chunk):
+            np.max(self._raw_data[first_point:first_point + samples_per_chunk])
+
+
+def memory_map_abf_data(abf_header):
+    """
+    :param abf_header: a pyabf.ABF of which only the header was read (loadData=False)
+    :return: an abf_data_reader of the data section of its file, read from the disk only where it is accessed
+    """
+    raw_data = np.asarray(np.memmap(abf_header.abfFilePath, dtype=abf_header._dtype, mode='r',
+                                    offset=abf_header.dataByteStart,
+                                    shape=(abf_header.dataPointCount // abf_header.channelCount,
+                                           abf_header.channelCount)))
+    is_scaled = abf_header._dtype == np.int16
+    return abf_data_reader(raw_data, abf_header.sweepCount, abf_header.sweepPointCount,
+                           abf_header._dataGain if is_scaled else None, abf_header._dataOffset if is_scaled else None)
+
+
+def iter_index_chunks(first_index, last_index, nr_of_rows, chunk_size=read_chunk_size):
+    """
+    splits the samples from first_index to last_index of a number of rows (e.g. sweeps) into chunks of at most
+    chunk_size samples of all rows together (but at least one sample per row)
+    :return: a generator of (first index, last index) of the chunks
+    """
+    samples_per_chunk = max(1, chunk_size // max(1, nr_of_rows))
+    for chunk_first_index in range(first_index, last_index, samples_per_chunk):
+        yield chunk_first_index, min(chunk_first_index + samples_per_chunk, last_index)
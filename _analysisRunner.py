@@ -0,0 +1,312 @@
+from _importer import *
+from _manifest import *
+from _loggerInitializer import *
+from _profiling import *
+from _pipeline import *
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import time
+
+### parameters ###
+watch_poll_interval = 2  # [sec] , how often a watched folder is checked for new or changed .abf files
+
+##################
+
+
+def make_log(abf_file):
+    output_folder_path = make_analysis_results_folder(abf_file)
+    initialize_logger(str(output_folder_path))
+
+
+def export_analyzed_abf(abf, npz_export=None, writer=None):
+    if writer is not None:  # the corrections are done by now, so the files can be written next to the analysis
+        writer.submit(export_analyzed_abf, abf, npz_export)
+        return
+    abf.export_analyzed_abf_data_to_csv()
+    if npz_export is not None:
+        abf.export_analyzed_abf_data_to_npz(use_float32=npz_export == 'float32')
+
+
+def analyze_abf_into_report(abf, input_option, npz_export=None, writer=None):
+    if input_option == 'v' or input_option == 'a':
+        corrections = ('pre_light_only', 'pre_and_after_light')
+    else:
+        corrections = ('pre_and_after_light',)
+    plot_sweeps = input_option == 'p' or input_option == 'a'
+    report_writer = pdf_report_writer(get_report_path(abf))
+    try:
+        plot_report(abf, report_writer, corrections, plot_sweeps, input_option == 'u' or input_option == 'a')
+        export_analyzed_abf(abf, npz_export, writer)
+    except AssertionError:
+        logging.warning('Could not correct the currents in this file. Plotting uncorrected currents and skipping.')
+        plot_report(abf, report_writer, (), plot_sweeps, plot_uncorrected=True)
+    finally:
+        report_writer.close()
+
+
+def analyze_abf(abf, input_option, npz_export=None, renderer=None, report=False, plots=True, writer=None):
+    msg = "analyzing file " + abf.which_abf_file() + " ..."
+    logging.info(msg)
+    if not plots:  # matplotlib is then never imported
+        try:
+            correct_all_sweeps(abf, 'pre_and_after_light')
+            export_analyzed_abf(abf, npz_export, writer)
+        except AssertionError:
+            logging.warning('Could not correct the currents in this file. Skipping.')
+        return
+    if report:
+        analyze_abf_into_report(abf, input_option, npz_export, writer)
+        return
+    if input_option == 'p' or input_option == 'a':
+        for i in range(abf.sweep_count()):
+            sweep_i = abf.get_sweep(i)
+            plot_sweep(sweep_i, save_fig=True, renderer=renderer)
+    if input_option == 'u' or input_option == 'a':
+        plot_all_sweeps(abf, save_fig=True, renderer=renderer)
+    try:
+        if input_option == 'v' or input_option == 'a':
+            plot_all_sweeps(abf, correction='pre_light_only', save_fig=True, renderer=renderer)
+        plot_all_sweeps(abf, correction='pre_and_after_light', save_fig=True, renderer=renderer)
+        export_analyzed_abf(abf, npz_export, writer)
+    except AssertionError:
+        logging.warning('Could not correct the currents in this file. Plotting uncorrected currents and skipping.')
+        plot_all_sweeps(abf, save_fig=True, renderer=renderer)
+
+
+def analyze_abf_file(abf_file, input_option, npz_export=None, renderer=None, report=False, plots=True, abf=None,
+                     writer=None):
+    # abf, if the file was already read (see prefetch_abf_files)
+    with timed_stage('file', abf_file=abf_file):
+        if abf is None:
+            with timed_stage('abf parsing'):
+                abf = import_single_abf(abf_file)
+        analyze_abf(abf, input_option, npz_export, renderer, report, plots, writer)
+
+
+def analyze_abf_file_in_worker(abf_file, input_option, fitting_backend, npz_export=None, fast_plotting=False,
+                               report=False, plots=True, warm_start=True):
+    log_collector = initialize_worker_logger()
+    set_fitting_backend(fitting_backend)
+    set_warm_start_fits(warm_start)
+    try:
+        # the workers already run next to each other, so each one renders its own plots
+        analyze_abf_file(abf_file, input_option, npz_export, plot_renderer() if fast_plotting else None, report, plots)
+        succeeded = True
+    except Exception:
+        logging.exception('The analysis of the file ' + abf_file + ' failed')
+        succeeded = False
+    return {'file': abf_file, 'succeeded': succeeded, 'log records': log_collector.records,
+            'stage records': pop_stage_records()}
+
+
+def analyze_abf_files_in_parallel(abf_files, input_option, jobs, npz_export=None, manifest_parameters=None,
+                                  fast_plotting=False, report=False, plots=True):
+    failed_files = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(analyze_abf_file_in_worker, abf_file, input_option,
+                                   get_fitting_backend(), npz_export, fast_plotting, report, plots,
+                                   get_warm_start_fits())
+                   for abf_file in abf_files]
+        for future in as_completed(futures):
+            result = future.result()
+            write_worker_log_records(result['log records'])
+            write_stage_records(make_analysis_results_folder(result['file']), result['stage records'],
+                                make_analysis_results_folder)
+            if not result['succeeded']:
+                failed_files.append(result['file'])
+            elif manifest_parameters is not None:
+                record_analysis(result['file'], manifest_parameters)
+    logging.info('analyzed {} of {} files successfully'.format(len(abf_files) - len(failed_files), len(abf_files)))
+    for failed_file in failed_files:
+        logging.warning('could not analyze the file ' + failed_file)
+    return failed_files
+
+
+def run(input_option, input_path, jobs=1, fitting_backend='lmfit', npz_export=None, force=False, fast_plotting=False,
+        report=False, plots=True, profile=False, trace_memory=False, recursive=False, pipeline=True, sweep_jobs=1):
+    """
+    analyzes an .abf file, or the .abf files of a folder (and if recursive, of all of its subfolders, into an
+    analysis_results folder each). only the paths are collected up front, each recording is parsed when its turn comes.
+    with pipeline (and one job), the next file is read and the outputs are written while a file is analyzed. with
+    sweep_jobs > 1 (and the files analyzed in this process), the lmfit fits of the sweeps of each recording are done in
+    that many processes, which helps with few recordings of many long sweeps (the fits are then not warm started, see
+    warm_start_fits). the time (and memory) each stage took is
+    written to timings.jsonl next to analysis.log, and with profile / trace_memory also a cProfile / tracemalloc summary
+    (of this process, so not of the workers if jobs > 1)
+    """
+    assert input_option is None or input_option == 'u' or input_option == 'p' or input_option == 'v' \
+           or input_option == 'a'
+    assert npz_export is None or npz_export == 'float64' or npz_export == 'float32'
+    assert jobs >= 1, 'the number of jobs should be at least 1, is: ' + str(jobs)
+    assert sweep_jobs >= 1, 'the number of sweep jobs should be at least 1, is: ' + str(sweep_jobs)
+    print('Input: option, path = ' + str(input_option) + ', ' + str(input_path))
+    set_fitting_backend(fitting_backend)
+    if input_path is None:
+        input_path = os.getcwd()
+    if Path(input_path).is_file():
+        abf_files = [input_path]
+    elif Path(input_path).is_dir():
+        abf_files = find_abfs_in_dic(input_path, recursive=recursive)
+    else:
+        raise ValueError('Bad path:' + str(input_path) + 'could not be found / is incorrect')
+    make_log(abf_files[0])  # the log (and profile) of a folder go to the results of its first file
+    warm_start = get_warm_start_fits()
+    # the sweeps fitted in a sweep pool cannot start from each other, so with sweep jobs none of the fits of the run
+    # are warm started (also not those in the workers of jobs > 1), and the same files give the same results
+    set_warm_start_fits(warm_start and (sweep_jobs == 1 or fitting_backend != 'lmfit'))
+    profiler = start_profiling(profile, trace_memory)
+    try:
+        analyze_abf_files(abf_files, input_option, jobs, npz_export, force, fast_plotting, report, plots, pipeline,
+                          sweep_jobs)
+    finally:
+        set_warm_start_fits(warm_start)
+        stop_profiling(profiler, make_analysis_results_folder(abf_files[0]))
+
+
+def analyze_abf_files(abf_files, input_option, jobs=1, npz_export=None, force=False, fast_plotting=False,
+                      report=False, plots=True, pipeline=True, sweep_jobs=1):
+    report = report and plots
+    fast_plotting = fast_plotting and not report and plots  # in a report, the plots are always drawn into its pages
+    manifest_parameters = get_manifest_parameters(input_option, npz_export, fast_plotting, report, plots)
+    if not force:
+        nr_of_abf_files = len(abf_files)
+        abf_files = select_outdated_abf_files(abf_files, manifest_parameters)
+        msg = 'skipping {} of {} files that are already up to date'.format(nr_of_abf_files - len(abf_files),
+                                                                           nr_of_abf_files)
+        print(msg)
+        logging.info(msg)
+    if jobs > 1 and len(abf_files) > 1:
+        analyze_abf_files_in_parallel(abf_files, input_option, jobs, npz_export, manifest_parameters, fast_plotting,
+                                      report, plots)
+        return
+    # the fast backend fits all sweeps at once anyway. the sweep pool is forked before the threads of the pipeline start
+    if sweep_jobs > 1 and get_fitting_backend() == 'lmfit' and abf_files:
+        set_sweep_workers(sweep_jobs)
+    renderer = None
+    writer = None
+    analyzed_abf_files = []
+    try:
+        renderer = plot_renderer(fast_plot_workers) if fast_plotting else None
+        writer = output_writer() if pipeline else None
+        read_abfs = prefetch_abf_files(abf_files) if pipeline else ((abf_file, None) for abf_file in abf_files)
+        for abf_file, abf in read_abfs:
+            if writer is not None:
+                writer.abf_file = abf_file
+            if renderer is not None:
+                renderer.abf_file = abf_file
+            try:
+                analyze_abf_file(abf_file, input_option, npz_export, renderer, report, plots, abf, writer)
+            finally:
+                write_stage_records(make_analysis_results_folder(abf_file),
+                                    output_folder_of_file=make_analysis_results_folder)
+            abf = None
+            analyzed_abf_files.append(abf_file)
+            if renderer is None and writer is None:
+                record_analysis(abf_file, manifest_parameters)
+    finally:
+        set_sweep_workers(1)
+        if renderer is not None or writer is not None:  # the outputs are only complete once they are all written
+            failed_abf_files = []
+            if writer is not None:
+                with timed_stage('output writing'):
+                    failed_abf_files = writer.close()
+            if renderer is not None:
+                with timed_stage('plot rendering'):
+                    failed_abf_files += renderer.close()
+            write_stage_records(make_analysis_results_folder(abf_files[0]) if abf_files else None,
+                                output_folder_of_file=make_analysis_results_folder)
+            for abf_file in analyzed_abf_files:
+                if abf_file not in failed_abf_files:
+                    record_analysis(abf_file, manifest_parameters)
+
+
+def analyze_watched_abf_file(abf_file, input_option, npz_export, renderer, report, plots, manifest_parameters):
+    try:
+        if renderer is not None:
+            renderer.abf_file = abf_file
+        analyze_abf_file(abf_file, input_option, npz_export, renderer, report, plots)
+        if renderer is not None:  # the outputs are only complete once the plots are rendered
+            with timed_stage('plot rendering', abf_file=abf_file):
+                if renderer.wait():  # the file is analyzed again once it changes, or the watching is restarted
+                    return
+        record_analysis(abf_file, manifest_parameters)
+        print('analyzed ' + abf_file)
+    except Exception:  # the watching goes on, the file is analyzed again once it changes
+        logging.exception('The analysis of the file ' + abf_file + ' failed')
+    finally:
+        write_stage_records(make_analysis_results_folder(abf_file), output_folder_of_file=make_analysis_results_folder)
+
+
+def watch(input_option, input_path, jobs=1, fitting_backend='lmfit', npz_export=None, fast_plotting=False,
+          report=False, plots=True, max_idle_polls=None, recursive=False):
+    """
+    watches a folder and analyzes each new or changed .abf file (e.g. as Clampex writes them) once it stopped growing,
+    until interrupted with ctrl+c. the files are analyzed one at a time in this process or, with jobs > 1, by a pool of
+    that many processes, which both keep the imported libraries loaded between the files
+    :param max_idle_polls: if given, the watching stops after that many polls in a row found nothing to analyze
+    :param recursive: whether the subfolders (e.g. of each day and cell) are watched as well
+    """
+    assert input_option is None or input_option == 'u' or input_option == 'p' or input_option == 'v' \
+           or input_option == 'a'
+    assert npz_export is None or npz_export == 'float64' or npz_export == 'float32'
+    assert jobs >= 1, 'the number of jobs should be at least 1, is: ' + str(jobs)
+    if input_path is None:
+        input_path = os.getcwd()
+    if not Path(input_path).is_dir():
+        raise ValueError('Bad path:' + str(input_path) + 'could not be found / is not a folder')
+    print('Watching: option, path = ' + str(input_option) + ', ' + str(input_path) + ' (stop with ctrl+c)')
+    set_fitting_backend(fitting_backend)
+    make_log(os.path.join(input_path, '*.abf'))  # the log of the watched folder
+    report = report and plots
+    fast_plotting = fast_plotting and not report and plots
+    manifest_parameters = get_manifest_parameters(input_option, npz_export, fast_plotting, report, plots)
+    file_watcher = abf_file_watcher(input_path, recursive=recursive)
+    waiting_abf_files = []
+    running_abf_files = {}  # future -> abf file, at most jobs at a time, the other files wait for their turn
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    renderer = plot_renderer(fast_plot_workers) if fast_plotting and executor is None else None
+    idle_polls = 0
+    try:
+        while max_idle_polls is None or idle_polls < max_idle_polls:
+            for abf_file in select_outdated_abf_files(file_watcher.poll(), manifest_parameters):
+                if abf_file not in waiting_abf_files:
+                    logging.info('queued the file ' + abf_file)
+                    waiting_abf_files.append(abf_file)
+            if executor is None:
+                if waiting_abf_files:
+                    analyze_watched_abf_file(waiting_abf_files.pop(0), input_option, npz_export, renderer, report,
+                                             plots, manifest_parameters)
+            else:
+                for future in [future for future in running_abf_files if future.done()]:
+                    abf_file = running_abf_files.pop(future)
+                    result = future.result()
+                    write_worker_log_records(result['log records'])
+                    write_stage_records(make_analysis_results_folder(abf_file), result['stage records'],
+                                        make_analysis_results_folder)
+                    if result['succeeded']:
+                        record_analysis(abf_file, manifest_parameters)
+                        print('analyzed ' + abf_file)
+                while waiting_abf_files and len(running_abf_files) < jobs:
+                    abf_file = waiting_abf_files.pop(0)
+                    running_abf_files[executor.submit(analyze_abf_file_in_worker, abf_file, input_option,
+                                                      fitting_backend, npz_export, fast_plotting, report,
+                                                      plots, get_warm_start_fits())] = abf_file
+            if waiting_abf_files or running_abf_files:
+                idle_polls = 0
+            else:
+                idle_polls += 1
+            if not waiting_abf_files or executor is not None:
+                time.sleep(watch_poll_interval)
+    except KeyboardInterrupt:
+        logging.info('stopped watching ' + str(input_path))
+    finally:
+        if executor is not None:
+            for future, abf_file in running_abf_files.items():  # the files that are being analyzed are finished
+                result = future.result()
+                write_worker_log_records(result['log records'])
+                write_stage_records(make_analysis_results_folder(abf_file), result['stage records'],
+                                    make_analysis_results_folder)
+                if result['succeeded']:
+                    record_analysis(abf_file, manifest_parameters)
+            executor.shutdown()
+        if renderer is not None:
+            renderer.close()
@@ -0,0 +1,162 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import logging
+
+### parameters ###
+plot_display_width = 1000       # [points] , the number of min/max pairs a trace is reduced to, about the plot's width
+fast_plot_dpi = 100             # the resolution of the raster plots
+fast_plot_workers = 2           # the number of processes rendering the plots next to the analysis
+
+##################
+
+_figure_templates = {}  # per process, the figures that are reused for every plot of the same kind
+
+
+def decimate_to_envelope(x, y, nr_of_bins=plot_display_width):
+    """
+    reduces a trace to the min and max of each of nr_of_bins bins, which looks the same as the full trace once drawn
+    at display resolution (unlike taking every n-th sample, no peaks are lost)
+    :return: the decimated x and y values, at most 2 * nr_of_bins of each
+    """
+    if len(y) <= 2 * nr_of_bins:
+        return np.asarray(x), np.asarray(y)
+    bin_starts = np.linspace(0, len(y), nr_of_bins + 1).astype(int)[:-1]
+    envelope_x = np.repeat(np.asarray(x)[bin_starts], 2)
+    envelope_y = np.empty(2 * nr_of_bins, dtype=np.asarray(y).dtype)
+    envelope_y[0::2] = np.minimum.reduceat(y, bin_starts)
+    envelope_y[1::2] = np.maximum.reduceat(y, bin_starts)
+    return envelope_x, envelope_y
+
+
+def make_sweep_plot_job(plot_path, times, currents, voltages, times_title, currents_title, voltages_title,
+                        t_shutter_on, t_shutter_off, specified_y_plot_range=None):
+    # everything needed to render a sweep plot elsewhere, with the traces already decimated
+    return {'kind': 'sweep', 'plot path': plot_path,
+            'traces': [decimate_to_envelope(times, currents), decimate_to_envelope(times, voltages)],
+            'labels': (times_title, currents_title, voltages_title), 'shutter': (t_shutter_on, t_shutter_off),
+            'y range': specified_y_plot_range}
+
+
+def make_all_sweeps_plot_job(plot_path, traces, legend_labels, times_title, currents_title, t_shutter_on,
+                             t_shutter_off, specified_y_plot_range=None):
+    # the same for a plot of all sweeps, where traces is a list of (times, currents) in the order of legend_labels
+    return {'kind': 'all sweeps', 'plot path': plot_path,
+            'traces': [decimate_to_envelope(times, currents) for times, currents in traces],
+            'legend labels': legend_labels, 'labels': (times_title, currents_title),
+            'shutter': (t_shutter_on, t_shutter_off), 'y range': specified_y_plot_range}
+
+
+def get_figure_template(kind):
+    if kind not in _figure_templates:
+        from matplotlib.figure import Figure
+        if kind == 'sweep':
+            fig = Figure()
+            axs = list(fig.subplots(2))
+            lines = [ax.plot([], [])[0] for ax in axs]
+        else:
+            fig = Figure()
+            axs = [fig.subplots(1)]
+            lines = []
+        for ax in axs:
+            ax.grid(alpha=.2)
+        _figure_templates[kind] = {'figure': fig, 'axes': axs, 'lines': lines, 'shutter spans': []}
+    return _figure_templates[kind]
+
+
+def update_figure_template(template, plot_job):
+    axs = template['axes']
+    lines = template['lines']
+    if plot_job['kind'] == 'all sweeps':
+        while len(lines) < len(plot_job['traces']):  # the lines are only created once, later plots reuse them
+            lines.append(axs[0].plot([], [], alpha=.5)[0])
+        for line in lines[len(plot_job['traces']):]:
+            line.set_visible(False)
+        axs[0].legend(lines[:len(plot_job['traces'])], plot_job['legend labels'], loc='upper left', prop={'size': 8})
+        axs[0].set(xlabel=plot_job['labels'][0], ylabel=plot_job['labels'][1])
+    else:
+        for ax, y_label in zip(axs, plot_job['labels'][1:]):
+            ax.set(xlabel=plot_job['labels'][0], ylabel=y_label)
+    for line, (x, y) in zip(lines, plot_job['traces']):
+        line.set_data(x, y)
+        line.set_visible(True)
+    for shutter_span in template['shutter spans']:
+        shutter_span.remove()
+    template['shutter spans'] = [ax.axvspan(plot_job['shutter'][0], plot_job['shutter'][1], color='orange', alpha=.3,
+                                            lw=0) for ax in axs]
+    for ax in axs:
+        ax.label_outer()  # Hide x labels and tick labels for top plots and y ticks for right plots.
+        ax.relim(visible_only=True)
+        ax.autoscale(True)
+        ax.autoscale_view()
+        if plot_job['y range']:
+            ax.set_ylim([plot_job['y range'][0], plot_job['y range'][1]])
+
+
+def render_plot_job(plot_job):
+    template = get_figure_template(plot_job['kind'])
+    update_figure_template(template, plot_job)
+    template['figure'].savefig(plot_job['plot path'], dpi=fast_plot_dpi)
+    return plot_job['plot path']
+
+
+class plot_renderer:
+    """
+    renders plot jobs with reused figures, either right away or, with workers, in other processes while the analysis
+    goes on. wait() waits for all of the plots submitted so far to be saved, close() also ends the workers. the plots
+    are attributed to the current abf_file
+    """
+
+    def __init__(self, workers=0, file_format='png'):
+        self.file_format = file_format
+        self.abf_file = None
+        self._executor = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+        self._futures = []  # (abf file, future)
+
+    def submit(self, plot_job):
+        plot_job['plot path'] = plot_job['plot path'] + '.' + self.file_format
+        if self._executor is None:
+            render_plot_job(plot_job)
+        else:
+            self._futures.append((self.abf_file, self._executor.submit(render_plot_job, plot_job)))
+
+    def wait(self):
+        """
+        waits for all of the plots submitted so far to be rendered
+        :return: the abf files of which a plot could not be rendered
+        """
+        failed_abf_files = []
+        for abf_file, future in self._futures:
+            try:
+                future.result()
+            except Exception:
+                logging.exception('A plot of the file ' + str(abf_file) + ' could not be rendered')
+                if abf_file not in failed_abf_files:
+                    failed_abf_files.append(abf_file)
+        self._futures = []
+        return failed_abf_files
+
+    def close(self):
+        if self._executor is None:
+            return []
+        failed_abf_files = self.wait()
+        self._executor.shutdown()
+        return failed_abf_files
+
+
+class pdf_report_writer:
+    """
+    streams plot jobs into the pages of a single multi-page pdf, which is opened only once, instead of into a file each
+    """
+
+    def __init__(self, report_path):
+        from matplotlib.backends.backend_pdf import PdfPages
+        self.report_path = report_path
+        self._pdf_pages = PdfPages(report_path)
+
+    def submit(self, plot_job):
+        template = get_figure_template(plot_job['kind'])
+        update_figure_template(template, plot_job)
+        self._pdf_pages.savefig(template['figure'])
+
+    def close(self):
+        self._pdf_pages.close()
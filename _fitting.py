@@ -1,8 +1,6 @@
-import matplotlib.patches as mpatches
-import matplotlib as plt
-from _abfAnalysis import *
 from _helpers import *
-from lmfit import Model
+from _profiling import timed
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import statistics
 import logging
@@ -15,9 +13,69 @@ default_start_of_pre_light_fit = 0.5            # [sec], the duration of time be
 red_chi_upper_threshold = 50                    # the maximum reduced chi value allowed for a correction to be accepted
 red_chi_significant_improvement_factor = 0.05   # the improvement factor above which the exponential fit will be used
                                                     #, where the improvemnt is calulated as 1-(red_chi_lin/red_chi_exp)
+fitting_backend = 'lmfit'                       # 'lmfit' / 'fast', where 'fast' solves the fits directly with numpy
+max_tau = 60                                    # [sec] , the upper bound of the time constant of exponential fits
+warm_start_fits = True                          # whether an exponential lmfit fit starts from the converged values of
+                                                    # the previous one (e.g. of the neighbouring sweep), if given a
+                                                    # fit_warm_start, instead of from guess_init_vals
+fast_fit_tau_grid_size = 60                     # the number of time constants first tried by the fast exponential fit
+fast_fit_tau_refinement_size = 11               # the number of time constants tried around the best one per refinement
+fast_fit_tau_refinements = 5                    # the number of refinements, each narrowing the best tau by ~10
+fast_fit_max_block_size = 2 ** 22               # the maximal number of exponential values evaluated at once
 
 ##################
 
+_sweep_pool = None  # with more than one sweep worker, the processes that fit the sweeps of a recording with lmfit
+
+
+def get_fit_parameters():  # the parameters that change the outcome of a correction, e.g. to tell if a stored one is outdated
+    return {'default_assumed_t_ss': default_assumed_t_ss,
+            'default_start_of_pre_light_fit': default_start_of_pre_light_fit,
+            'red_chi_upper_threshold': red_chi_upper_threshold,
+            'red_chi_significant_improvement_factor': red_chi_significant_improvement_factor,
+            'fitting_backend': fitting_backend, 'warm_start_fits': warm_start_fits}
+
+
+def get_fitting_backend():
+    return fitting_backend
+
+
+def set_fitting_backend(backend):
+    global fitting_backend
+    if backend not in ('lmfit', 'fast'):
+        logging.error('the fitting backend should be lmfit / fast. Is, however, ' + str(backend))
+        raise ValueError
+    fitting_backend = backend
+
+
+def get_warm_start_fits():
+    return warm_start_fits
+
+
+def set_warm_start_fits(enabled):
+    global warm_start_fits
+    warm_start_fits = enabled
+
+
+def get_sweep_pool():
+    return _sweep_pool
+
+
+def set_sweep_workers(workers):
+    """
+    with more than one worker, the lmfit fits of the sweeps of a recording (see fit_intervals_of_sweeps) are done in a
+    pool of that many processes, which is kept for the following recordings until the workers are set to 1 again. the
+    processes are forked right away, so the pool should be set up before any other thread (e.g. of the pipeline) starts
+    """
+    global _sweep_pool
+    assert workers >= 1, 'the number of sweep workers should be at least 1, is: ' + str(workers)
+    if _sweep_pool is not None:
+        _sweep_pool.shutdown()
+        _sweep_pool = None
+    if workers > 1:
+        _sweep_pool = ProcessPoolExecutor(max_workers=workers)
+        _sweep_pool.submit(int).result()  # the first task starts all of the processes
+
 
 def linear(t, m, y0):
     return m * t + y0
@@ -31,6 +89,11 @@ def two_first_oder_sys_responses(t, y0_1, y0_2, y_ss_1, y_ss_2, tau_1, tau_2):
     return (y0_1 - y_ss_1) * np.exp(-t / tau_1) + (y0_2 - y_ss_2) * np.exp(-t / tau_2) + y_ss_1 + y_ss_2
 
 
+fit_functions = {'linear': linear,
+                 'exponential': first_oder_sys_response,
+                 'double exponential': two_first_oder_sys_responses}
+
+
 def get_r_squared_from_fit_results(fit_results):
     ss_res = np.sum(fit_results.residual ** 2)
     ss_tot = np.sum((fit_results.data - np.mean(fit_results.data)) ** 2)
@@ -88,6 +151,8 @@ def guess_init_vals(x, y, function_name):
 
 
 def plot_fit(x, y, fit_result):
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as mpatches
     print(fit_result.fit_report())
     fig, ax = plt.subplots(1)
     ax.plot(x, y, 'bo')
@@ -103,11 +168,46 @@ def plot_fit(x, y, fit_result):
     fig.show()
 
 
+class fit_warm_start:
+    """
+    carries the converged values of an exponential lmfit fit over to the next one, e.g. of the neighbouring sweep of the
+    same protocol, and counts the work (function evaluations) of the fits, so that it can be compared with cold starts
+    """
+
+    def __init__(self):
+        self.values = None  # the converged values of the last fit, if it succeeded
+        self.fits = 0
+        self.warm_started_fits = 0
+        self.failed_warm_starts = 0  # the warm started fits that failed, after which the fit was started cold
+        self.function_evaluations = 0
+
+    def add_fit(self, fit_result, warm_started):
+        self.fits += 1
+        self.function_evaluations += fit_result.nfev
+        if warm_started:
+            self.warm_started_fits += 1
+            if is_failed_fit(fit_result):
+                self.failed_warm_starts += 1
+
+    def keep_values_of(self, fit_result):
+        # a time constant at its bound (e.g. of an almost linear drift) would stall the next fit there, so after such a
+        # fit (or a poor one) the next one is started cold
+        self.values = None if is_failed_fit(fit_result) else dict(fit_result.best_values)
+
+    def get_fit_work(self):
+        return {'fits': self.fits, 'warm started fits': self.warm_started_fits,
+                'failed warm starts': self.failed_warm_starts, 'function evaluations': self.function_evaluations}
+
+
 def fit_linear(x, y, make_plot=False):
-    init_m, init_y0 = guess_init_vals(x, y, 'linear')
-    fit_model = Model(linear)
-    params = fit_model.make_params(y0=init_y0, m=init_m)
-    result = fit_model.fit(y, params, t=x)
+    if fitting_backend == 'fast':
+        result = fast_fit_linear(x, y)[0]
+    else:
+        from lmfit import Model  # only imported by the lmfit backend, as it takes long to import
+        init_m, init_y0 = guess_init_vals(x, y, 'linear')
+        fit_model = Model(linear)
+        params = fit_model.make_params(y0=init_y0, m=init_m)
+        result = fit_model.fit(y, params, t=x)
 
     if make_plot:
         plot_fit(x, y, result)
@@ -115,38 +215,73 @@ def fit_linear(x, y, make_plot=False):
     return 'linear', result
 
 
-def fit_exponential(x, y, fixed_y0=None, t_shift=0, make_plot=False):
-    fit_model = Model(first_oder_sys_response)
-
-    if fixed_y0 is None:
-        y0, y_ss, tau = guess_init_vals(x, y, 'exponential')
-        fit_model.set_param_hint('tau', value=tau, min=0, max=60)
-        params = fit_model.make_params(y0=y0, y_ss=y_ss)
-    elif fixed_y0 is not None:
-        if t_shift == 0:
-            y_ss, tau = guess_init_vals(x, y, 'exponential from zero')
-            fit_model.set_param_hint('tau', value=tau, min=0, max=60)
-            fit_model.set_param_hint('y0', value=fixed_y0, vary=False)
-            params = fit_model.make_params(y_ss=y_ss)
-        elif t_shift > 0:
-            x = x - t_shift
-            y_ss, tau = guess_init_vals(x, y, 'exponential from zero')
-            fit_model.set_param_hint('tau', value=tau, min=0, max=60)
-            fit_model.set_param_hint('y0', value=fixed_y0, vary=False)
-            params = fit_model.make_params(y_ss=y_ss)
-        else:
-            logging.error('t_shift should be the time when the shutter is turned on (>= 0) but is:', str(t_shift))
-            raise ValueError
-    else:
-        logging.error('starting_from_0 should be None/ the value of the fixed y0. is: ' + str(fixed_y0))
+def fit_exponential(x, y, fixed_y0=None, t_shift=0, make_plot=False, warm_start=None):
+    if fixed_y0 is not None and t_shift < 0:
+        logging.error('t_shift should be the time when the shutter is turned on (>= 0) but is:', str(t_shift))
         raise ValueError
-    exp_result = fit_model.fit(y, params, t=x)
-    exp_red_chi = exp_result.redchi
+    if fixed_y0 is not None and t_shift > 0:
+        x = x - t_shift
+    exp_result = fit_first_oder_sys_response(x, y, fixed_y0=fixed_y0, warm_start=warm_start)
     if make_plot:
         plot_fit(x, y, exp_result)
 
     linear_fit = fit_linear(x, y, make_plot=make_plot)
-    linear_result = linear_fit[1]
+    return select_best_dark_current_fit(exp_result, linear_fit[1])
+
+
+def fit_first_oder_sys_response(x, y, fixed_y0=None, warm_start=None):
+    """
+    :param warm_start: a fit_warm_start. with warm_start_fits, the fit starts from its values (if it has any), and only
+    if that fails (see is_failed_fit) from guess_init_vals as well, of which the better fit is kept. the values of this
+    fit are then kept in it for the next one
+    """
+    if fitting_backend == 'fast':
+        return fast_fit_exponential(x, y, fixed_y0=fixed_y0)[0]
+    warm_result = None
+    if warm_start is not None and warm_start_fits and warm_start.values is not None:
+        warm_result = fit_first_oder_sys_response_from(x, y, warm_start.values, fixed_y0)
+        warm_start.add_fit(warm_result, warm_started=True)
+        if not is_failed_fit(warm_result):
+            warm_start.keep_values_of(warm_result)
+            return warm_result
+    if fixed_y0 is None:
+        y0, y_ss, tau = guess_init_vals(x, y, 'exponential')
+    else:
+        y0 = fixed_y0
+        y_ss, tau = guess_init_vals(x, y, 'exponential from zero')
+    result = fit_first_oder_sys_response_from(x, y, {'y0': y0, 'y_ss': y_ss, 'tau': tau}, fixed_y0)
+    if warm_start is not None:
+        warm_start.add_fit(result, warm_started=False)
+    if warm_result is not None and warm_result.success and \
+            (not result.success or warm_result.redchi < result.redchi):
+        result = warm_result
+    if warm_start is not None:
+        warm_start.keep_values_of(result)
+    return result
+
+
+def is_failed_fit(fit_result):
+    # a warm started fit can also converge, but get stuck at a bound of tau or in a poor local minimum
+    tau = fit_result.best_values['tau']
+    return not fit_result.success or tau <= 0 or np.isclose(tau, max_tau) or \
+        fit_result.redchi > red_chi_upper_threshold
+
+
+def fit_first_oder_sys_response_from(x, y, init_values, fixed_y0=None):
+    # the lmfit fit of fit_first_oder_sys_response, started from the given y0, y_ss and tau (y0 is ignored if fixed)
+    from lmfit import Model
+    fit_model = Model(first_oder_sys_response)
+    fit_model.set_param_hint('tau', value=init_values['tau'], min=0, max=max_tau)
+    if fixed_y0 is None:
+        params = fit_model.make_params(y0=init_values['y0'], y_ss=init_values['y_ss'])
+    else:
+        fit_model.set_param_hint('y0', value=fixed_y0, vary=False)
+        params = fit_model.make_params(y_ss=init_values['y_ss'])
+    return fit_model.fit(y, params, t=x)
+
+
+def select_best_dark_current_fit(exp_result, linear_result):
+    exp_red_chi = exp_result.redchi
     lin_red_chi = linear_result.redchi
 
     improvement_factor_of_exp_fit = 1-lin_red_chi/exp_red_chi
@@ -169,22 +304,187 @@ def fit_exponential(x, y, fixed_y0=None, t_shift=0, make_plot=False):
         raise AssertionError
 
 
-def fit_pre_light(sweep, initial_fit_type, t0=None, make_plot=False):
+class FastFitResult:
+    # holds the parts of an lmfit ModelResult that are used here, for fits that were solved without lmfit
+    def __init__(self, function_name, best_values, data, best_fit, nvarys):
+        self.function_name = function_name
+        self.best_values = best_values
+        self.data = data
+        self.best_fit = best_fit
+        self.init_fit = best_fit
+        self.residual = best_fit - data
+        self.ndata = len(data)
+        self.nvarys = nvarys
+        self.nfree = self.ndata - nvarys
+        self.chisqr = float(np.sum(self.residual ** 2))
+        self.redchi = self.chisqr / self.nfree
+
+    def fit_report(self):
+        return '[[Fast fit of {}]]\n    chi-square = {}\n    reduced chi-square = {}\n'.format(
+            self.function_name, self.chisqr, self.redchi) + \
+            '\n'.join('    {} = {}'.format(name, value) for name, value in self.best_values.items())
+
+
+def fast_fit_linear(x, y):
+    """
+    solves linear fits exactly via least squares
+    :param x: np array of x values
+    :param y: np array of y values, or a 2-d np array with one row of y values per sweep
+    :return: a list with a FastFitResult per row of y
+    """
+    data = np.atleast_2d(y)
+    x_mean = np.mean(x)
+    centered_x = x - x_mean
+    m = (data @ centered_x) / (centered_x @ centered_x)
+    y0 = np.mean(data, axis=1) - m * x_mean
+    return [FastFitResult('linear', {'m': float(m[i]), 'y0': float(y0[i])}, data[i], linear(x, m[i], y0[i]), 2)
+            for i in range(len(data))]
+
+
+def fast_fit_exponential(x, y, fixed_y0=None):
+    """
+    solves first order system response fits without lmfit: for a fixed tau the fit is linear, so a grid of taus is
+    solved via least squares (for all rows of y at once), after which the grid is refined around the best tau
+    :param x: np array of x values
+    :param y: np array of y values, or a 2-d np array with one row of y values per sweep
+    :param fixed_y0: None / the value of a fixed y0
+    :return: a list with a FastFitResult per row of y
+    """
+    data = np.atleast_2d(y)
+    # a free y0 is fitted relative to the first x, so that the exponential does not underflow for small taus, and
+    # taus for which y0 itself would overflow are not tried
+    x_ref = x[0] if fixed_y0 is None else 0
+    min_tau = max(x[1] - x[0], abs(x_ref) / 300)
+    rows_per_block = max(1, fast_fit_max_block_size // (len(x) * fast_fit_tau_refinement_size))
+    results = []
+    for first_row in range(0, len(data), rows_per_block):
+        block = data[first_row:first_row + rows_per_block]
+        taus = np.geomspace(min_tau, max_tau, fast_fit_tau_grid_size)[np.newaxis, :]
+        for refinement in range(fast_fit_tau_refinements + 1):
+            sse, amplitude, y_ss = exponential_least_squares(x - x_ref, block, taus, fixed_y0)
+            best_tau_index = np.argmin(sse, axis=1)
+            taus = np.broadcast_to(taus, sse.shape)
+            if refinement == fast_fit_tau_refinements:
+                break
+            rows = np.arange(len(block))
+            lower_tau = taus[rows, np.maximum(best_tau_index - 1, 0)]
+            upper_tau = taus[rows, np.minimum(best_tau_index + 1, taus.shape[1] - 1)]
+            taus = lower_tau[:, np.newaxis] * (upper_tau / lower_tau)[:, np.newaxis] ** \
+                np.linspace(0, 1, fast_fit_tau_refinement_size)[np.newaxis, :]
+        for i in range(len(block)):
+            tau = taus[i, best_tau_index[i]]
+            if fixed_y0 is None:
+                y_ss_i = y_ss[i, best_tau_index[i]]
+                y0 = y_ss_i + amplitude[i, best_tau_index[i]] * np.exp(x_ref / tau)
+                best_values, nvarys = {'y0': float(y0), 'y_ss': float(y_ss_i), 'tau': float(tau)}, 3
+            else:
+                best_values, nvarys = {'y0': fixed_y0, 'y_ss': float(y_ss[i, best_tau_index[i]]), 'tau': float(tau)}, 2
+            results.append(FastFitResult('exponential', best_values, block[i],
+                                         first_oder_sys_response(x, **best_values), nvarys))
+    return results
+
+
+def exponential_least_squares(x, data, taus, fixed_y0=None):
+    """
+    the least squares solutions of y = amplitude * exp(-x / tau) + y_ss for every row of data and each of its taus
+    :param x: np array of x values
+    :param data: 2-d np array with one row of y values per sweep
+    :param taus: 2-d np array of taus, with either one row per row of data or a single row shared by all of them
+    :param fixed_y0: None / the value of a fixed y0 (i.e. amplitude = y0 - y_ss)
+    :return: the sum of squared residuals, the amplitudes and the y_ss values, each with a column per tau
+    """
+    nr_of_points = len(x)
+    exponentials = np.exp(-x[np.newaxis, :, np.newaxis] / taus[:, np.newaxis, :])
+    exp_sum = np.sum(exponentials, axis=1)
+    exp_dot_exp = np.einsum('snk,snk->sk', exponentials, exponentials)
+    exp_dot_y = np.matmul(data[:, np.newaxis, :], exponentials)[:, 0, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if fixed_y0 is None:
+            y_mean = np.mean(data, axis=1, keepdims=True)
+            centered_y_dot_y = np.sum((data - y_mean) ** 2, axis=1, keepdims=True)
+            centered_exp_dot_y = exp_dot_y - exp_sum * y_mean
+            centered_exp_dot_exp = exp_dot_exp - exp_sum ** 2 / nr_of_points
+            amplitude = centered_exp_dot_y / centered_exp_dot_exp
+            y_ss = y_mean - amplitude * exp_sum / nr_of_points
+            sse = centered_y_dot_y - amplitude * centered_exp_dot_y
+        else:
+            # y - y0 * exp = y_ss * (1 - exp), so only y_ss is left to solve
+            rest_dot_rest = nr_of_points - 2 * exp_sum + exp_dot_exp
+            rest_dot_y = np.sum(data, axis=1, keepdims=True) - exp_dot_y - fixed_y0 * (exp_sum - exp_dot_exp)
+            y_ss = rest_dot_y / rest_dot_rest
+            sse = np.sum(data ** 2, axis=1, keepdims=True) - 2 * fixed_y0 * exp_dot_y + fixed_y0 ** 2 * exp_dot_exp - \
+                rest_dot_y * y_ss
+            amplitude = fixed_y0 - y_ss
+    sse = np.where(np.isfinite(sse), sse, np.inf)
+    return sse, amplitude, y_ss
+
+
+def fit_exponential_of_all(x, y):
+    # the fast backend's fit_exponential for many sweeps (rows of y) at once
+    exp_results = fast_fit_exponential(x, y)
+    linear_results = fast_fit_linear(x, y)
+    return [select_best_dark_current_fit(exp_result, linear_result)
+            for exp_result, linear_result in zip(exp_results, linear_results)]
+
+
+def fit_of_all(x, y, initial_fit_type):
+    if initial_fit_type == 'exponential':
+        return fit_exponential_of_all(x, y)
+    if initial_fit_type == 'linear':
+        return [('linear', result) for result in fast_fit_linear(x, y)]
+    else:
+        logging.error('this function was not implemented for the initial_fit_type:', initial_fit_type)
+        raise NotImplementedError
+
+
+@timed('fits of all sweeps')
+def fit_intervals_of_sweeps(sweeps, fit_intervals, currents, initial_fit_type):
+    # with the fast backend, the sweeps with the same interval (sweeps of a protocol share their times and usually
+    # their epochs) are fitted together. with lmfit, each sweep is fitted in a process of the sweep pool (and as the
+    # sweeps are then fitted at the same time, without warm starts)
+    if get_fitting_backend() == 'lmfit':
+        assert _sweep_pool is not None, 'the sweeps can only be fitted together with the fast backend or a sweep pool'
+        fitting_function = {'exponential': fit_exponential, 'linear': fit_linear}[initial_fit_type]
+        return list(_sweep_pool.map(fitting_function,
+                                    [sweep.times[first_index:last_index] for sweep, (first_index, last_index)
+                                     in zip(sweeps, fit_intervals)],
+                                    [sweep_currents[first_index:last_index] for sweep_currents, (first_index, last_index)
+                                     in zip(currents, fit_intervals)]))
+    fits = [None] * len(sweeps)
+    sweeps_per_interval = {}
+    for i, fit_interval in enumerate(fit_intervals):
+        sweeps_per_interval.setdefault(fit_interval, []).append(i)
+    for (first_index, last_index), sweep_indices in sweeps_per_interval.items():
+        fit_time = sweeps[sweep_indices[0]].times[first_index:last_index]
+        fit_currents = np.array([currents[i][first_index:last_index] for i in sweep_indices])
+        for i, fit in zip(sweep_indices, fit_of_all(fit_time, fit_currents, initial_fit_type)):
+            fits[i] = fit
+    return fits
+
+
+def get_pre_light_fit_interval(sweep, t0=None):
     sweep_times = sweep.times
-    sweep_currents = sweep.currents
     t_light_on = sweep.t_shutter_on
-    t_light_on_index = get_index_of_closest_value(t_light_on, sweep_times)
+    t_light_on_index = get_index_of_closest_value(t_light_on, sweep_times, sweep.sample_interval)
     if t0 is None:
         t0 = t_light_on - default_start_of_pre_light_fit
     assert (t0 > sweep.t_clamp_on), 'the first fit should not start before the capacitance peak: ' + str(
         t0) + ' > ' + str(sweep.t_clamp_on)
     assert sweep_times[0] <= t0 <= sweep_times[-1], 't0 is out of range sweep interval'
-    t0_index = get_index_of_closest_value(t0, sweep_times)
+    t0_index = get_index_of_closest_value(t0, sweep_times, sweep.sample_interval)
+    return t0_index, t_light_on_index
+
+
+@timed('pre light fit')
+def fit_pre_light(sweep, initial_fit_type, t0=None, make_plot=False, warm_start=None):
+    sweep_times = sweep.times
+    sweep_currents = sweep.original_currents  # the dark currents are always fitted before any correction
+    t0_index, t_light_on_index = get_pre_light_fit_interval(sweep, t0)
 
     fit_time = sweep_times[t0_index:t_light_on_index]
     fit_current = sweep_currents[t0_index:t_light_on_index]
     if initial_fit_type == 'exponential':
-        return fit_exponential(fit_time, fit_current, make_plot=make_plot)
+        return fit_exponential(fit_time, fit_current, make_plot=make_plot, warm_start=warm_start)
     if initial_fit_type == 'linear':
         return fit_linear(fit_time, fit_current, make_plot=make_plot)
     else:
@@ -192,9 +492,15 @@ def fit_pre_light(sweep, initial_fit_type, t0=None, make_plot=False):
         raise NotImplementedError
 
 
-def fit_also_after_light(sweep, initial_fit_type, t_ss, make_plot=False, fit_only_close_to_t_ss=False):
+def fit_pre_light_of_sweeps(sweeps, initial_fit_type, t0=None):
+    # fit_pre_light for many sweeps at once, with the fast backend or in the sweep pool
+    fit_intervals = [get_pre_light_fit_interval(sweep, t0) for sweep in sweeps]
+    return fit_intervals_of_sweeps(sweeps, fit_intervals, [sweep.original_currents for sweep in sweeps],
+                                   initial_fit_type)
+
+
+def get_after_light_fit_interval(sweep, t_ss, fit_only_close_to_t_ss=False):
     sweep_times = sweep.times
-    sweep_currents = sweep.currents
     t_light_off = sweep.t_shutter_off
     t_clamp_off = sweep.t_clamp_off
     if fit_only_close_to_t_ss:
@@ -202,13 +508,22 @@ def fit_also_after_light(sweep, initial_fit_type, t_ss, make_plot=False, fit_onl
     else:
         t_end_fit = t_clamp_off - 0.01
 
-    t_end_fit_index = get_index_of_closest_value(t_end_fit, sweep_times)
-    t_ss_index = get_index_of_closest_value(t_ss, sweep_times)
+    t_end_fit_index = get_index_of_closest_value(t_end_fit, sweep_times, sweep.sample_interval)
+    t_ss_index = get_index_of_closest_value(t_ss, sweep_times, sweep.sample_interval)
+    return t_ss_index, t_end_fit_index
+
+
+@timed('after light fit')
+def fit_also_after_light(sweep, initial_fit_type, t_ss, make_plot=False, fit_only_close_to_t_ss=False,
+                         warm_start=None):
+    sweep_times = sweep.times
+    sweep_currents = sweep.currents
+    t_ss_index, t_end_fit_index = get_after_light_fit_interval(sweep, t_ss, fit_only_close_to_t_ss)
 
     fit_time = sweep_times[t_ss_index:t_end_fit_index]
     fit_current = sweep_currents[t_ss_index:t_end_fit_index]
     if initial_fit_type == 'exponential':
-        return fit_time, fit_exponential(fit_time, fit_current, make_plot=make_plot)
+        return fit_time, fit_exponential(fit_time, fit_current, make_plot=make_plot, warm_start=warm_start)
     if initial_fit_type == 'linear':
         return fit_time, fit_linear(fit_time, fit_current, make_plot=make_plot)
     else:
@@ -216,8 +531,20 @@ def fit_also_after_light(sweep, initial_fit_type, t_ss, make_plot=False, fit_onl
         raise NotImplementedError
 
 
+def fit_after_light_of_sweeps(sweeps, initial_fit_type, t_ss=None, fit_only_close_to_t_ss=False):
+    # fit_also_after_light for many sweeps at once with the fast backend, with the default t_ss of each sweep if
+    # t_ss is not specified
+    fit_intervals = [get_after_light_fit_interval(sweep, sweep.t_shutter_off + default_assumed_t_ss if t_ss is None
+                                                  else t_ss, fit_only_close_to_t_ss) for sweep in sweeps]
+    fits = fit_intervals_of_sweeps(sweeps, fit_intervals, [sweep.currents for sweep in sweeps], initial_fit_type)
+    return [(sweep.times[first_index:last_index], fit)
+            for sweep, (first_index, last_index), fit in zip(sweeps, fit_intervals, fits)]
+
+
+@timed('baseline construction')
 def calculate_linear_photocurrent_baseline(sweep, t_ss=None, fit_also_after_t_ss=True,
-                                           fit_after_function='exponential'):
+                                           fit_after_function='exponential', return_after_light_fit=False,
+                                           after_light_fit=None, warm_start=None):
     sweep_times = sweep.times
     sweep_currents = sweep.currents
     t_light_on = sweep.t_shutter_on
@@ -230,9 +557,10 @@ def calculate_linear_photocurrent_baseline(sweep, t_ss=None, fit_also_after_t_ss
                                                'not after the voltage clamp is off: {0} < {1} < {2}'.format(
         str(t_light_off), str(t_ss), str(t_clamp_off))
     assert sweep_times[0] <= t_ss <= sweep_times[-1], 'the steady state time is out of the range of the sweep interval'
-    recorded_t_light_on = get_closest_value_from_ordered_array(t_light_on, sweep_times)
-    recorded_t_ss = get_closest_value_from_ordered_array(t_ss, sweep_times)
-    t_ss_index = get_index_of_unique_value(recorded_t_ss, sweep_times)
+    t_light_on_index = get_index_of_closest_value(t_light_on, sweep_times, sweep.sample_interval)
+    recorded_t_light_on = float(sweep_times[t_light_on_index])
+    t_ss_index = get_index_of_closest_value(t_ss, sweep_times, sweep.sample_interval)
+    recorded_t_ss = float(sweep_times[t_ss_index])
 
     # before the light
     baseline = np.zeros(len(sweep_currents))
@@ -242,38 +570,47 @@ def calculate_linear_photocurrent_baseline(sweep, t_ss=None, fit_also_after_t_ss
     deltax = recorded_t_ss - t_light_on
     slope = deltay / deltax
 
-    t_value_index = 0
-    for t_value in sweep_times:
-        if recorded_t_light_on <= t_value <= recorded_t_ss:
-            baseline[t_value_index] = linear(t_value - recorded_t_light_on, slope, 0)
-        elif t_value > recorded_t_ss:
-            baseline[t_value_index] = linear(recorded_t_ss - recorded_t_light_on, slope, 0)
-        t_value_index += 1
+    baseline[t_light_on_index:t_ss_index + 1] = linear(sweep_times[t_light_on_index:t_ss_index + 1] - recorded_t_light_on,
+                                                       slope, 0)
+    baseline[t_ss_index + 1:] = linear(recorded_t_ss - recorded_t_light_on, slope, 0)
 
+    fit_results = None
     if fit_also_after_t_ss:
-        fit_times, fit_results = fit_also_after_light(sweep, fit_after_function, t_ss)
+        if after_light_fit is None:
+            after_light_fit = fit_also_after_light(sweep, fit_after_function, t_ss, warm_start=warm_start)
+        fit_times, fit_results = after_light_fit
         estimated_currents_after_t_ss_via_fit = estimate_data_with_fit(fit_times, fit_results[0], fit_results[1])
-        baseline_shaped_est_currents = np.zeros(shape=sweep_times.shape)
-        for i in range(len(estimated_currents_after_t_ss_via_fit)):
-            baseline_shaped_est_currents[t_ss_index + i] = estimated_currents_after_t_ss_via_fit[i] - \
-                                                           estimated_currents_after_t_ss_via_fit[0]
-        baseline += baseline_shaped_est_currents
+        baseline[t_ss_index:t_ss_index + len(estimated_currents_after_t_ss_via_fit)] += \
+            estimated_currents_after_t_ss_via_fit - estimated_currents_after_t_ss_via_fit[0]
     # plt.plot(sweep_times, baseline) # plot to view the correction baseline
+    if return_after_light_fit:
+        return baseline, fit_results
     return baseline
 
 
-def estimate_data_with_fit(t, function, fit_result):
+def estimate_data_with_fit(t, function, fit_result, out=None):
+    """
+    evaluates the fitted function on a whole array at once
+    :param t: np array of the times to evaluate the fit at
+    :param function: a function name from fit_functions, e.g. 'linear' / 'exponential'
+    :param fit_result: the lmfit result of the fit
+    :param out: an optional np array with the shape of t to write the estimate into instead of allocating a new one
+    :return: the estimated data (out, if given)
+    """
     fit_result_values = fit_result.best_values
-    y = np.zeros(shape=t.shape)
-    if function == 'exponential':
-        y0 = fit_result_values['y0']
-        y_ss = fit_result_values['y_ss']
-        tau = fit_result_values['tau']
-        for i in range(len(t)):
-            y[i] = first_oder_sys_response(t[i], y0, y_ss, tau)
-    if function == 'linear':
-        m = fit_result_values['m']
-        y0 = fit_result_values['y0']
-        for i in range(len(t)):
-            y[i] = linear(t[i], m, y0)
-    return y
+    if out is None:
+        out = np.empty(shape=t.shape)
+    if function == 'linear':  # evaluated in place, so that no temporary arrays are allocated
+        np.multiply(t, fit_result_values['m'], out=out)
+        out += fit_result_values['y0']
+    elif function == 'exponential':
+        np.divide(t, -fit_result_values['tau'], out=out)
+        np.exp(out, out=out)
+        out *= fit_result_values['y0'] - fit_result_values['y_ss']
+        out += fit_result_values['y_ss']
+    elif function in fit_functions:
+        out[...] = fit_functions[function](t, **fit_result_values)
+    else:
+        logging.error('this function was not implemented for the function: ' + str(function))
+        raise NotImplementedError
+    return out
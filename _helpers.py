@@ -15,22 +15,35 @@ def verify_value_is_in_array(value, np_array):
         np_array[0]) + ' <= ' + str(value) + ' <= ' + str(np_array[-1])
 
 
-def get_closest_value_from_ordered_array(value, np_array):  # Gets the first one and stops there!
-    verify_value_is_in_array(value, np_array)
-    last_value = None
-    for i in np.nditer(np_array):
-        if abs(np_array[0]) < abs(np_array[1]):
-            if abs(i) > value:
-                return float(last_value)
-        elif abs(np_array[0]) > abs(np_array[1]):
-            if abs(i) < value:
-                return float(last_value)
-        if i == value:
-            return float(value)
-        else:
-            last_value = i
-            pass
-    raise ValueError('value not found in np array')
+def get_indices_of_closest_values(values, np_array, sample_interval=None):
+    """
+    vectorized form of get_index_of_closest_value: for each value, gets the index of the last element of the ordered
+    array that is not above it (i.e. the first one, and stops there)
+    :param values: a single value or an np array of values (of any shape) within the range of the array
+    :param np_array: an ordered np array, e.g. sweep times
+    :param sample_interval: if the array is uniformly sampled (like the sweep times, sampled every dataSecPerPoint),
+    the indices are calculated arithmetically in O(1) instead of via a binary search
+    :return: an np array of indices with the shape of the values
+    """
+    values = np.asarray(values, dtype=float)
+    assert np.all((np_array[0] <= values) & (values <= np_array[-1])), 'values out of range of the array values: ' + \
+        str(np_array[0]) + ' <= ' + str(values) + ' <= ' + str(np_array[-1])
+    last_index = len(np_array) - 1
+    if sample_interval is not None:
+        indices = np.clip(np.floor((values - np_array[0]) / sample_interval).astype(np.intp), 0, last_index)
+        # the division can be off by one sample because of floating point rounding, so the neighbours are checked
+        next_indices = np.minimum(indices + 1, last_index)
+        indices = np.where(np_array[next_indices] <= values, next_indices, indices)
+        indices = np.where(np_array[indices] > values, np.maximum(indices - 1, 0), indices)
+        next_indices = np.minimum(indices + 1, last_index)
+        if np.all((np_array[indices] <= values) & ((indices == last_index) | (np_array[next_indices] > values))):
+            return indices
+    indices = np.searchsorted(np_array, values, side='right') - 1
+    return np.searchsorted(np_array, np_array[indices], side='left')  # the first one if there are a few
+
+
+def get_closest_value_from_ordered_array(value, np_array, sample_interval=None):  # Gets the first one and stops there!
+    return float(np_array[get_index_of_closest_value(value, np_array, sample_interval)])
 
 
 def get_index_of_unique_value(value, np_array):  # returns the first one of there are a few!
@@ -38,6 +51,96 @@ def get_index_of_unique_value(value, np_array):  # returns the first one of ther
     return int(np.where(np_array == value)[0][0])
 
 
-def get_index_of_closest_value(value, np_array):
-    closest_val = get_closest_value_from_ordered_array(value, np_array)
-    return get_index_of_unique_value(closest_val, np_array)
+def get_index_of_closest_value(value, np_array, sample_interval=None):
+    verify_value_is_in_array(value, np_array)
+    return int(get_indices_of_closest_values(value, np_array, sample_interval))
+
+
+def get_window_statistics(stack, starts, ends):
+    """
+    the mean and the standard deviation of a window in each row of a 2-D array (e.g. sweeps x samples), all at once
+    :param stack: a 2-D np array
+    :param starts: the first index of the window of each row (or of all rows)
+    :param ends: the index after the last one of the window of each row (or of all rows)
+    :return: np arrays of the means and of the standard deviations, one per row
+    """
+    starts = np.broadcast_to(starts, (len(stack),))
+    ends = np.broadcast_to(ends, (len(stack),))
+    if np.all(starts == starts[0]) and np.all(ends == ends[0]):  # the sweeps of one protocol share their windows
+        window = stack[:, starts[0]:ends[0]]
+        return np.mean(window, axis=1), np.std(window, axis=1)
+    sample_indices = np.arange(stack.shape[1])
+    in_window = (sample_indices >= starts[:, np.newaxis]) & (sample_indices < ends[:, np.newaxis])
+    counts = np.sum(in_window, axis=1)
+    means = np.sum(stack, axis=1, where=in_window) / counts
+    sds = np.sqrt(np.sum((stack - means[:, np.newaxis]) ** 2, axis=1, where=in_window) / counts)
+    return means, sds
+
+
+def get_chunked_window_statistics(chunks, windows):
+    """
+    get_window_statistics of several windows at once, in a single pass over the chunks of a 2-D array (e.g. of a long
+    recording, read a chunk at a time). the statistics of the parts of a window in each chunk are merged, so a window
+    may span chunks, and one that lies within a single chunk gets exactly the statistics of get_window_statistics
+    :param chunks: (the index of the first column of the chunk, the chunk as a 2-D np array) pairs, in any order
+    :param windows: (starts, ends) pairs, each as in get_window_statistics
+    :return: a (means, standard deviations) pair of np arrays per window, one value per row
+    """
+    window_statistics = [None] * len(windows)  # per window, the counts, means and standard deviations so far
+    for first_index, chunk in chunks:
+        last_index = first_index + chunk.shape[1]
+        for i, (starts, ends) in enumerate(windows):
+            chunk_starts = np.clip(np.broadcast_to(starts, (len(chunk),)), first_index, last_index) - first_index
+            chunk_ends = np.clip(np.broadcast_to(ends, (len(chunk),)), first_index, last_index) - first_index
+            chunk_counts = np.maximum(chunk_ends - chunk_starts, 0)
+            if not np.any(chunk_counts):
+                continue
+            with np.errstate(invalid='ignore', divide='ignore'):  # the rows of which no part is in this chunk
+                chunk_means, chunk_sds = get_window_statistics(chunk, chunk_starts, np.maximum(chunk_ends, chunk_starts))
+            if window_statistics[i] is None:
+                window_statistics[i] = (chunk_counts, chunk_means, chunk_sds)
+                continue
+            counts, means, sds = window_statistics[i]
+            merged_counts = counts + chunk_counts
+            with np.errstate(invalid='ignore', divide='ignore'):
+                deltas = chunk_means - means
+                merged_means = means + deltas * chunk_counts / merged_counts
+                merged_sds = np.sqrt((sds ** 2 * counts + chunk_sds ** 2 * chunk_counts +
+                                      deltas ** 2 * counts * chunk_counts / merged_counts) / merged_counts)
+            # a row of which only one of the two has a part keeps the statistics of that part as they are
+            window_statistics[i] = (merged_counts,
+                                    np.where(chunk_counts == 0, means, np.where(counts == 0, chunk_means, merged_means)),
+                                    np.where(chunk_counts == 0, sds, np.where(counts == 0, chunk_sds, merged_sds)))
+    return [(means, sds) for _, means, sds in window_statistics]
+
+
+def get_window_noise(stack, starts, ends):
+    """
+    a robust estimate of the white noise in a window in each row of a 2-D array (e.g. sweeps x samples), all at once,
+    from the median absolute deviation of the differences of consecutive samples, which a drift or a few spikes barely
+    affect
+    :param stack: a 2-D np array
+    :param starts: the first index of the window of each row (or of all rows)
+    :param ends: the index after the last one of the window of each row (or of all rows), at least 2 after its start
+    :return: an np array of the noise standard deviations, one per row
+    """
+    starts = np.broadcast_to(starts, (len(stack),))
+    ends = np.broadcast_to(ends, (len(stack),))
+    first_index, last_index = np.min(starts), np.max(ends)
+    differences = np.diff(stack[:, first_index:last_index], axis=1).astype(float)
+    if not (np.all(starts == starts[0]) and np.all(ends == ends[0])):
+        difference_indices = np.arange(first_index, last_index - 1)
+        in_window = (difference_indices >= starts[:, np.newaxis]) & (difference_indices < ends[:, np.newaxis] - 1)
+        differences[~in_window] = np.nan
+    median_differences = np.nanmedian(differences, axis=1)
+    return 1.4826 * np.nanmedian(np.abs(differences - median_differences[:, np.newaxis]), axis=1) / np.sqrt(2)
+
+
+def to_structured_array(columns):
+    # a dictionary of equally long columns as a structured np array, with a field per column (in the same order)
+    columns = {name: np.asarray(values) for name, values in columns.items()}
+    structured_array = np.empty(len(next(iter(columns.values()))),
+                                dtype=[(name, values.dtype) for name, values in columns.items()])
+    for name, values in columns.items():
+        structured_array[name] = values
+    return structured_array
@@ -1,8 +1,14 @@
 from _abfAnalysis import *
-import pandas as pd
-import glob as glob
+import fnmatch
+import os
+import time
 from pathlib import Path
 
+### parameters ###
+watch_settle_time = 5        # [sec] , how long a watched .abf file should stay unchanged before it counts as complete
+
+##################
+
 
 def import_single_abf(abf_path):
     file_path_as_object = Path(abf_path)
@@ -11,14 +17,129 @@ def import_single_abf(abf_path):
     return ActiveAbf(abf_path)
 
 
-def import_abfs_from_dic(folder_path, file_name_pattern='*.abf'):
+class abf_file_handle:
+    """
+    an .abf file that was found, of which only the path, the size and the modification time are known. the recording
+    itself is only parsed by import_abf
+    """
+    __slots__ = ('path', 'size', 'mtime_ns')
+
+    def __init__(self, path, size, mtime_ns):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    def import_abf(self):
+        return import_single_abf(self.path)
+
+    def __repr__(self):
+        return 'abf_file_handle(' + repr(self.path) + ')'
+
+
+def iter_abf_files(folder_path, file_name_pattern='*.abf', recursive=False):
+    """
+    lists the .abf files of a folder with os.scandir, and if recursive, depth first those of its subfolders (e.g. of
+    each day and cell) as well, one folder at a time. the analysis_results folders are skipped
+    :return: a generator of abf_file_handle, sorted by name within each folder
+    """
+    folder_paths = [str(folder_path)]
+    while folder_paths:
+        current_folder_path = folder_paths.pop()
+        try:
+            with os.scandir(current_folder_path) as folder_entries:
+                folder_entries = sorted(folder_entries, key=lambda folder_entry: folder_entry.name)
+        except OSError:  # e.g. removed in the meantime, or no permission
+            logging.warning('Could not list the folder ' + current_folder_path)
+            continue
+        subfolder_paths = []
+        for folder_entry in folder_entries:
+            if folder_entry.is_dir(follow_symlinks=False):
+                if recursive and folder_entry.name != 'analysis_results':
+                    subfolder_paths.append(folder_entry.path)
+            elif fnmatch.fnmatch(folder_entry.name, file_name_pattern) and folder_entry.is_file():
+                try:
+                    folder_entry_stat = folder_entry.stat()
+                except OSError:  # e.g. a temporary file that was renamed or removed in the meantime
+                    continue
+                yield abf_file_handle(folder_entry.path, folder_entry_stat.st_size, folder_entry_stat.st_mtime_ns)
+        folder_paths.extend(reversed(subfolder_paths))
+
+
+def find_abf_files(folder_path, file_name_pattern='*.abf', recursive=False, sort_by=None, min_size=0,
+                   modified_after=None, modified_before=None):
+    """
+    :param sort_by: None to yield the files as soon as they are found, or 'path', 'name', 'size' or 'mtime' to sort
+    all of them first
+    :param min_size: [bytes] , smaller files (e.g. ones Clampex has only started to write) are skipped
+    :param modified_after: None, or a time [sec since the epoch, as time.time()] , older files are skipped
+    :param modified_before: None, or a time [sec since the epoch] , newer files are skipped
+    :return: a generator of abf_file_handle
+    """
+    assert sort_by is None or sort_by in ('path', 'name', 'size', 'mtime'), 'cannot sort by ' + str(sort_by)
+    abf_files = (abf_file for abf_file in iter_abf_files(folder_path, file_name_pattern, recursive)
+                 if abf_file.size >= min_size and
+                 (modified_after is None or abf_file.mtime_ns >= modified_after * 1e9) and
+                 (modified_before is None or abf_file.mtime_ns <= modified_before * 1e9))
+    if sort_by is None:
+        return abf_files
+    sort_key = {'path': lambda abf_file: abf_file.path, 'name': lambda abf_file: abf_file.name,
+                'size': lambda abf_file: abf_file.size, 'mtime': lambda abf_file: abf_file.mtime_ns}[sort_by]
+    return iter(sorted(abf_files, key=sort_key))
+
+
+def find_abfs_in_dic(folder_path, file_name_pattern='*.abf', recursive=False):
     folder_path_as_object = Path(folder_path)
     assert folder_path_as_object.is_dir(), 'The given path seems to be invalid (not a directory); given path : {} ' \
         .format(folder_path_as_object)
-    list_of_abfs = glob.glob(folder_path + file_name_pattern)
+    list_of_abfs = [abf_file.path for abf_file in find_abf_files(folder_path, file_name_pattern, recursive,
+                                                                 sort_by='path')]
     assert list_of_abfs, 'No files were found in the path {} '.format(folder_path)
-    list_of_active_abf_objects = [ActiveAbf(i) for i in list_of_abfs]
-    return list_of_active_abf_objects
+    return list_of_abfs
+
+
+def import_abfs_from_dic(folder_path, file_name_pattern='*.abf', recursive=False):
+    # a generator, each file is only parsed once the previous one is done with, so only one is in memory at a time
+    for abf_file in find_abf_files(folder_path, file_name_pattern, recursive):
+        yield abf_file.import_abf()
+
+
+class abf_file_watcher:
+    """
+    polls a folder for .abf files and reports each file once it has stopped growing, and again whenever it changes.
+    polling (instead of file system events) works on any mount, e.g. on a network share
+    """
+
+    def __init__(self, folder_path, settle_time=watch_settle_time, file_name_pattern='*.abf', recursive=False):
+        self.folder_path = folder_path
+        self.settle_time = settle_time
+        self.file_name_pattern = file_name_pattern
+        self.recursive = recursive
+        self._file_states = {}  # abf file -> ((size, mtime), the time since which it is known to be unchanged)
+        self._reported_file_states = {}
+
+    def poll(self):
+        """
+        :return: the .abf files that became complete (or changed and became complete again) since the last poll
+        """
+        now = time.monotonic()
+        complete_abf_files = []
+        for abf_file_found in find_abf_files(self.folder_path, self.file_name_pattern, self.recursive, sort_by='path'):
+            abf_file = abf_file_found.path
+            file_state = (abf_file_found.size, abf_file_found.mtime_ns)
+            if abf_file not in self._file_states or self._file_states[abf_file][0] != file_state:
+                # a file that is seen for the first time is assumed to be unchanged since it was last modified
+                unchanged_for = max(0., time.time() - abf_file_found.mtime_ns / 1e9) \
+                    if abf_file not in self._file_states else 0.
+                self._file_states[abf_file] = (file_state, now - unchanged_for)
+            if now - self._file_states[abf_file][1] >= self.settle_time and file_state[0] > 0 and \
+                    self._reported_file_states.get(abf_file) != file_state:
+                self._reported_file_states[abf_file] = file_state
+                complete_abf_files.append(abf_file)
+        return complete_abf_files
 
 
 # Import *_sweeps.csv file
@@ -26,16 +147,26 @@ def import_sweeps_from_csv(path):
     file_path_as_object = Path(path)
     assert file_path_as_object.match('*_sweeps.csv'), 'The given path is not a sweeps csv file; given path : {} '. \
         format(file_path_as_object)
+    import pandas as pd
+    return import_sweeps_from_dataframe(pd.read_csv(path), file_path_as_object.stem)
+
+
+# Import the sweeps summary of an *_analyzed.npz file, the same way as from a *_sweeps.csv file
+def import_sweeps_from_npz(path):
+    import pandas as pd
+    analyzed_data = import_analyzed_abf_data_from_npz(path)
+    return import_sweeps_from_dataframe(pd.DataFrame(analyzed_data['sweeps']), analyzed_data['name'] + '_sweeps')
 
+
+def import_sweeps_from_dataframe(df, name):
     def DF_nparray_to_1_dim_list(nparray):
         return list(nparray.reshape((nparray.size,)))
 
-    df = pd.read_csv(path)
     imported_data = {"voltagesAsNpyArray": df[[col for col in df if "4_voltage" in col]].to_numpy(),
                      "voltagesStdAsNpyArray": df[[col for col in df if "5_SD_of_voltage" in col]].to_numpy(),
                      "currentsAsNpyArray": df[[col for col in df if "2_currents" in col]].to_numpy(),
                      "currentsStdAsNpyArray": df[[col for col in df if "3_SD_of_currents" in col]].to_numpy(),
-                     "name": file_path_as_object.stem}
+                     "name": name}
     imported_data["voltages"] = DF_nparray_to_1_dim_list(imported_data["voltagesAsNpyArray"])
     imported_data["currents"] = DF_nparray_to_1_dim_list(imported_data["currentsAsNpyArray"])
     imported_data["voltages_std"] = DF_nparray_to_1_dim_list(imported_data["voltagesStdAsNpyArray"])
@@ -45,3 +176,19 @@ def import_sweeps_from_csv(path):
     imported_data["weights"] = list(imported_data["weightsAsNpyArray"].reshape((imported_data["weightsAsNpyArray"].size,)))
 
     return imported_data
+
+
+# Import *_analyzed.npz file
+def import_analyzed_abf_data_from_npz(path):
+    file_path_as_object = Path(path)
+    assert file_path_as_object.match('*_analyzed.npz'), 'The given path is not an analyzed npz file; given path : {} '. \
+        format(file_path_as_object)
+    with np.load(path) as analyzed_data:
+        imported_data = {"name": file_path_as_object.stem[:-len('_analyzed')],
+                         "times": analyzed_data['times'],
+                         "uncorrected currents": analyzed_data['uncorrected currents'],
+                         "corrected currents": analyzed_data['corrected currents'],
+                         "voltages": analyzed_data['voltages'],
+                         "sweeps": {key[len('sweeps/'):]: analyzed_data[key] for key in analyzed_data.files
+                                    if key.startswith('sweeps/')}}
+    return imported_data
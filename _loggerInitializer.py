@@ -12,3 +12,35 @@ def initialize_logger(output_dir):
     formatter = logging.Formatter("%(asctime)s : %(levelname)s - %(message)s")
     handler.setFormatter(formatter)
     logger.addHandler(handler)
+
+
+class LogRecordCollector(logging.Handler):
+    # keeps the log records of a worker process so they can be written to the analysis.log of the main process
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.records = []
+
+    def emit(self, record):
+        # the records are sent back between processes, so everything that might not be picklable is formatted now
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+def initialize_worker_logger():
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    for handler in list(logger.handlers):  # handlers inherited from the main process would write to the log directly
+        logger.removeHandler(handler)
+    collector = LogRecordCollector()
+    logger.addHandler(collector)
+    return collector
+
+
+def write_worker_log_records(records):
+    logger = logging.getLogger()
+    for record in records:
+        logger.handle(record)
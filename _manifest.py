@@ -0,0 +1,116 @@
+from _abfAnalysis import *
+import hashlib
+import json
+import re
+
+### parameters ###
+manifest_file_name = 'analysis_manifest.json'  # the name of the manifest in each analysis_results folder
+hash_block_size = 2 ** 20                      # [bytes] , the size of the blocks in which an .abf file is hashed
+
+##################
+
+
+def get_output_file_pattern(abf_file):  # the names of all of the files an analysis of the .abf file could write
+    return re.compile(re.escape(Path(abf_file).stem) + r'_(all_sweeps_.+_plot\.(pdf|png)|sweep_\d+_plot\.(pdf|png)|'
+                                                       r'report\.pdf|currents\.csv|sweeps\.csv|analyzed\.npz)$')
+
+
+def get_output_files(abf_file):
+    output_file_pattern = get_output_file_pattern(abf_file)
+    return sorted(output_file.name for output_file in make_analysis_results_folder(abf_file).iterdir()
+                  if output_file_pattern.match(output_file.name))
+
+
+def get_file_hash(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(hash_block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_manifest_parameters(input_option, npz_export=None, fast_plotting=False, report=False, plots=True):
+    # the run options change which outputs are written, so an analysis with other options is also outdated
+    manifest_parameters = get_analysis_parameters()
+    manifest_parameters.update({'run option': input_option, 'npz export': npz_export, 'fast plotting': fast_plotting,
+                                'report': report, 'plots': plots})
+    return manifest_parameters
+
+
+def load_manifest(analysis_results_folder):
+    manifest_path = Path(analysis_results_folder) / manifest_file_name
+    if not manifest_path.is_file():
+        return {}
+    try:
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    except ValueError:
+        logging.warning('The manifest ' + str(manifest_path) + ' could not be read, all files will be analyzed')
+        return {}
+
+
+def save_manifest(analysis_results_folder, manifest):
+    manifest_path = Path(analysis_results_folder) / manifest_file_name
+    temporary_manifest_path = manifest_path.with_suffix('.tmp')  # so that an interrupted run never corrupts the manifest
+    with open(temporary_manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(temporary_manifest_path, manifest_path)
+
+
+def is_up_to_date(manifest_entry, abf_file, manifest_parameters):
+    """
+    checks whether the outputs of an earlier analysis of an .abf file can be kept. the file is only hashed if its size
+    is unchanged but its modification time is not, e.g. after it was copied
+    :return: whether the outputs are up to date, and whether the manifest entry was updated
+    """
+    if manifest_entry is None or manifest_entry['parameters'] != manifest_parameters:
+        return False, False
+    analysis_results_folder = make_analysis_results_folder(abf_file)
+    if not all((analysis_results_folder / output_file).is_file() for output_file in manifest_entry['outputs']):
+        return False, False
+    abf_file_stat = os.stat(abf_file)
+    if manifest_entry['size'] != abf_file_stat.st_size:
+        return False, False
+    if manifest_entry['mtime'] == abf_file_stat.st_mtime_ns:
+        return True, False
+    if manifest_entry['sha256'] != get_file_hash(abf_file):
+        return False, False
+    manifest_entry['mtime'] = abf_file_stat.st_mtime_ns
+    return True, True
+
+
+def select_outdated_abf_files(abf_files, manifest_parameters):
+    """
+    :param abf_files: a list of .abf file paths
+    :param manifest_parameters: the parameters of the current run, see get_manifest_parameters
+    :return: the .abf files that are new, were changed or were analyzed with other parameters since the last run
+    """
+    outdated_abf_files = []
+    manifests = {}
+    updated_analysis_results_folders = set()
+    for abf_file in abf_files:
+        analysis_results_folder = make_analysis_results_folder(abf_file)
+        if analysis_results_folder not in manifests:
+            manifests[analysis_results_folder] = load_manifest(analysis_results_folder)
+        manifest_entry = manifests[analysis_results_folder].get(Path(abf_file).name)
+        up_to_date, entry_was_updated = is_up_to_date(manifest_entry, abf_file, manifest_parameters)
+        if entry_was_updated:
+            updated_analysis_results_folders.add(analysis_results_folder)
+        if not up_to_date:
+            outdated_abf_files.append(abf_file)
+    for analysis_results_folder in updated_analysis_results_folders:
+        save_manifest(analysis_results_folder, manifests[analysis_results_folder])
+    return outdated_abf_files
+
+
+def record_analysis(abf_file, manifest_parameters):
+    # called after an .abf file was analyzed, so that the next run can skip it as long as nothing changed
+    analysis_results_folder = make_analysis_results_folder(abf_file)
+    manifest = load_manifest(analysis_results_folder)
+    abf_file_stat = os.stat(abf_file)
+    manifest[Path(abf_file).name] = {'size': abf_file_stat.st_size,
+                                     'mtime': abf_file_stat.st_mtime_ns,
+                                     'sha256': get_file_hash(abf_file),
+                                     'parameters': manifest_parameters,
+                                     'outputs': get_output_files(abf_file)}
+    save_manifest(analysis_results_folder, manifest)
@@ -0,0 +1,107 @@
+from _importer import import_single_abf
+from _profiling import timed_stage
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import queue
+import threading
+
+### parameters ###
+pipeline_prefetch_files = 1  # the number of .abf files that are read ahead of the one that is being analyzed
+pipeline_writer_threads = 2  # the number of threads that write the data files (.csv and .npz)
+pipeline_queue_size = 8      # the number of outputs that may wait to be written before the analysis waits for them
+
+##################
+
+
+def prefetch_abf_files(abf_files, prefetch=pipeline_prefetch_files):
+    """
+    reads the .abf files in a thread, at most prefetch files ahead of the one that is being analyzed, so that the disk
+    (e.g. a network drive) is read while the analysis goes on. the data sections are only read into the system's file
+    cache (see abf_data_reader.read_ahead), they are memory-mapped by the analysis
+    :param abf_files: the paths of the .abf files, in the order they are analyzed
+    :return: a generator of (abf file, ActiveAbf). a file that could not be read raises its error once it is its turn
+    """
+    read_abfs = queue.Queue()
+    free_slots = threading.Semaphore(prefetch + 1)  # the file that is being analyzed, and the ones read ahead of it
+    stop_reading = threading.Event()
+
+    def read_abf_files():
+        for abf_file in abf_files:
+            free_slots.acquire()
+            if stop_reading.is_set():
+                return
+            try:
+                with timed_stage('abf parsing', abf_file=abf_file):
+                    abf = import_single_abf(abf_file)
+                    abf.data_reader.read_ahead()
+                    read_abfs.put((abf_file, abf, None))
+                    abf = None  # not kept alive by this thread once it is analyzed
+            except Exception as exception:
+                read_abfs.put((abf_file, None, exception))
+        read_abfs.put(None)
+
+    reader = threading.Thread(target=read_abf_files, name='abf reader', daemon=True)
+    reader.start()
+    try:
+        while True:
+            read_abf = read_abfs.get()
+            if read_abf is None:
+                return
+            abf_file, abf, exception = read_abf
+            if exception is not None:
+                raise exception
+            read_abf = None
+            yield abf_file, abf
+            abf = None  # the file was analyzed and is let go of, so the next one can be read
+            free_slots.release()
+    finally:
+        stop_reading.set()
+        free_slots.release()  # in case the reader waits for a slot
+        reader.join()
+
+
+class output_writer:
+    """
+    writes the data files (export_analyzed_abf) in a pool of threads while the analysis goes on (the plots are saved
+    by the analysis itself, as matplotlib is not thread-safe). at most queue_size outputs wait to be written, after
+    which submit waits, so that the analysis never runs too far ahead of a slow drive. the outputs are attributed to
+    the current abf_file
+    """
+
+    def __init__(self, threads=pipeline_writer_threads, queue_size=pipeline_queue_size):
+        self.abf_file = None
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='output writer')
+        self._free_slots = threading.Semaphore(queue_size)
+        self._futures = []  # (abf file, future)
+
+    def submit(self, function, *args, **kwargs):
+        self._free_slots.acquire()
+        future = self._executor.submit(self._write, self.abf_file, function, args, kwargs)
+        future.add_done_callback(lambda _: self._free_slots.release())
+        self._futures.append((self.abf_file, future))
+
+    @staticmethod
+    def _write(abf_file, function, args, kwargs):
+        with timed_stage('writing', abf_file=abf_file):
+            function(*args, **kwargs)
+
+    def wait(self):
+        """
+        waits for all of the outputs submitted so far to be written
+        :return: the abf files of which an output could not be written
+        """
+        failed_abf_files = []
+        for abf_file, future in self._futures:
+            try:
+                future.result()
+            except Exception:
+                logging.exception('An output of the file ' + str(abf_file) + ' could not be written')
+                if abf_file not in failed_abf_files:
+                    failed_abf_files.append(abf_file)
+        self._futures = []
+        return failed_abf_files
+
+    def close(self):
+        failed_abf_files = self.wait()
+        self._executor.shutdown()
+        return failed_abf_files
@@ -0,0 +1,147 @@
+import cProfile
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:  # not available on windows, where the max rss is then not recorded
+    resource = None
+
+### parameters ###
+timings_file_name = 'timings.jsonl'        # the stage timings, one json object per line, next to analysis.log
+profile_file_name = 'profile.pstats'       # the cProfile stats of a profiled run, can be opened with pstats
+profile_summary_file_name = 'profile.txt'  # the slowest functions of a profiled run
+memory_summary_file_name = 'memory.txt'    # the lines that allocated the most memory in a run with traced memory
+profile_summary_length = 40                # the number of functions / lines in the summaries
+
+##################
+
+_stage_records = []  # per process, the timings that were not yet written
+_stage_records_lock = threading.Lock()  # the stages of the reader and writer threads (see _pipeline) are recorded too
+_open_stages = threading.local()  # per thread, the stages that are running, outermost first
+
+
+def get_max_rss():  # [MB] , the peak memory use of this process so far
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10  # bytes on macOS, kilobytes otherwise
+
+
+class timed_stage:
+    """
+    records how long a stage of the analysis took (wall and cpu time) and the memory used by then. stages can be nested,
+    in which case the time of a stage includes the ones within it, and the file of the outer stage is used if none is
+    given
+    """
+
+    def __init__(self, stage, sweep_nr=None, abf_file=None):
+        self.stage = stage
+        self.sweep_nr = sweep_nr
+        self.abf_file = abf_file
+
+    def __enter__(self):
+        if not hasattr(_open_stages, 'stages'):
+            _open_stages.stages = []
+        open_stages = _open_stages.stages
+        self.within = open_stages[-1].stage if open_stages else None
+        if self.abf_file is None and open_stages:
+            self.abf_file = open_stages[-1].abf_file
+        open_stages.append(self)
+        self._start_time = time.time()
+        self._start_wall_time = time.perf_counter()
+        self._start_cpu_time = time.process_time()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        wall_time = time.perf_counter() - self._start_wall_time
+        cpu_time = time.process_time() - self._start_cpu_time
+        _open_stages.stages.remove(self)
+        stage_record = {'file': self.abf_file, 'sweep': self.sweep_nr, 'stage': self.stage, 'within': self.within,
+                        'started': self._start_time, 'wall [sec]': wall_time, 'cpu [sec]': cpu_time,
+                        'max rss [MB]': get_max_rss(), 'failed': exception_type is not None}
+        if tracemalloc.is_tracing():
+            traced_memory, traced_memory_peak = tracemalloc.get_traced_memory()
+            stage_record['traced [MB]'] = traced_memory / 2 ** 20
+            stage_record['traced peak [MB]'] = traced_memory_peak / 2 ** 20
+        with _stage_records_lock:
+            _stage_records.append(stage_record)
+        return False
+
+
+def timed(stage):
+    # records every call of the decorated function as a stage, of the sweep if the first argument is a sweep
+    def decorator(function):
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            with timed_stage(stage, sweep_nr=getattr(args[0], 'sweep_nr', None) if args else None):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorator
+
+
+def pop_stage_records():
+    global _stage_records
+    with _stage_records_lock:
+        stage_records, _stage_records = _stage_records, []
+    return stage_records
+
+
+def write_stage_records(output_folder, stage_records=None, output_folder_of_file=None):
+    """
+    appends the given (by default, all of the so far unwritten) stage timings to the timings file
+    :param output_folder: where the timings go, or with output_folder_of_file, the ones that are of no file
+    :param output_folder_of_file: a function that gives the output folder of the file of a timing (e.g.
+    make_analysis_results_folder), so that the timings of each file go next to its analysis
+    """
+    if stage_records is None:
+        stage_records = pop_stage_records()
+    stage_records_per_folder = {}
+    for stage_record in stage_records:
+        stage_output_folder = output_folder if output_folder_of_file is None or stage_record['file'] is None \
+            else output_folder_of_file(stage_record['file'])
+        stage_records_per_folder.setdefault(stage_output_folder, []).append(stage_record)
+    for stage_output_folder, folder_stage_records in stage_records_per_folder.items():
+        if stage_output_folder is None:
+            continue
+        with open(os.path.join(str(stage_output_folder), timings_file_name), 'a') as timings_file:
+            for stage_record in folder_stage_records:
+                timings_file.write(json.dumps(stage_record) + '\n')
+
+
+def start_profiling(profile=False, trace_memory=False):
+    """
+    :param profile: whether to profile the functions that are called with cProfile
+    :param trace_memory: whether to trace the memory allocations with tracemalloc (which slows down the analysis)
+    :return: the profiler, if profile, to be given to stop_profiling
+    """
+    if trace_memory:
+        tracemalloc.start()
+    if not profile:
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profiling(profiler, output_folder):
+    # writes the profile and the memory summary (of whichever was started) into the output folder
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(str(output_folder), profile_file_name))
+        with open(os.path.join(str(output_folder), profile_summary_file_name), 'w') as profile_summary_file:
+            pstats.Stats(profiler, stream=profile_summary_file).sort_stats('cumulative').print_stats(
+                profile_summary_length)
+    if tracemalloc.is_tracing():
+        memory_statistics = tracemalloc.take_snapshot().statistics('lineno')
+        _, traced_memory_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with open(os.path.join(str(output_folder), memory_summary_file_name), 'w') as memory_summary_file:
+            memory_summary_file.write('traced peak: {:.1f} MB\n'.format(traced_memory_peak / 2 ** 20))
+            for memory_statistic in memory_statistics[:profile_summary_length]:
+                memory_summary_file.write(str(memory_statistic) + '\n')